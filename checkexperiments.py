@@ -7,21 +7,290 @@ Example.
         --out experiments_statuses.log https://www.encodeproject.org
 """
 import datetime
-import json
+import functools
+import io
+import socket
 import sys
-import copy
 import os.path
-import subprocess
-from urllib.parse import urljoin
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from urllib.parse import parse_qsl, urljoin
+import orjson
 import requests
+from portal_session import make_session
 from slackclient import SlackClient
 
 EPILOG = __doc__
 
+# log lines are flushed at the end of the run rather than one by one
+LOG_BUFFER_SIZE = 1 << 16
+
+# keeps batched search URLs well under server URL length limits
+ACCESSIONS_PER_SEARCH = 100
+
+# threads sending status updates while the experiments are still screened
+PATCH_THREADS = 4
+
+# only experiments that can be screened are worth fetching, so let the
+# search drop the rest; process_experiment() still rechecks both
+SCREENING_FILTERS = [('status', 'in progress'), ('award.rfa!', 'modERN')]
+
+
+def screening_filters(search_query=''):
+    # the portal ORs repeated values of a field, so a filter on a field the
+    # query already constrains would widen the query instead of narrowing it
+    fields = {field.rstrip('!') for field, _ in parse_qsl(search_query)}
+    return [(field, value) for field, value in SCREENING_FILTERS
+            if field.rstrip('!') not in fields]
+
+# we don't have at the moment minimal requirements for ChIA and HiC
+# that being the reason for specifying at least one read in each replicate
+MINIMAL_READ_DEPTH_REQUIREMENTS = {
+    'DNase-seq': 20000000,
+    'genetic modification followed by DNase-seq': 20000000,
+    'ChIP-seq': 20000000,
+    'RAMPAGE': 10000000,
+    'shRNA knockdown followed by RNA-seq': 10000000,
+    'siRNA knockdown followed by RNA-seq': 10000000,
+    'single cell isolation followed by RNA-seq': 10000000,
+    'CRISPR genome editing followed by RNA-seq': 10000000,
+    'modENCODE-chip': 500000,
+    'ChIA-PET': 1,
+    'HiC': 1
+}
+
+
+PATCH_HEADERS = {
+    'content-type': 'application/json',
+    'accept': 'application/json'
+}
+
+# fastqs in these states don't count toward a replicate's read depth
+ERRONEOUS_FILE_STATUSES = frozenset(['uploading', 'content error', 'upload failed'])
+
+
+class LogTee(object):
+    """Write to a log file while keeping its contents in memory."""
+
+    def __init__(self, f):
+        self.f = f
+        self.name = f.name
+        self.buf = io.StringIO()
+
+    def write(self, s):
+        self.buf.write(s)
+        return self.f.write(s)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def getvalue(self):
+        return self.buf.getvalue()
+
+
+def link_id(value):
+    # embedded frames expand links into the objects they point to
+    if isinstance(value, dict):
+        return value.get('@id')
+    return value
+
+
+@functools.lru_cache(maxsize=512)
+def get_award(award_id, session, url):
+    # a few dozen awards are shared by thousands of experiments
+    award_request = session.get(urljoin(
+        url,
+        award_id + '?frame=object&format=json'))
+    return orjson.loads(award_request.content)
+
+
+def search_linked_objects(item_type, ids, fields, session, url):
+    params = [('type', item_type), ('limit', 'all')]
+    params += [('field', field) for field in fields]
+    params += [('@id', item_id) for item_id in ids]
+    r = session.get(urljoin(url, '/search/'), params=params)
+    r.raise_for_status()
+    return orjson.loads(r.content)['@graph']
+
+
+def read_accession_batches(accessions_list):
+    # streams the file so the whole list is never held in memory
+    if not os.path.isfile(accessions_list):
+        return
+    with open(accessions_list) as accessions_file:
+        accessions = (line.strip() for line in accessions_file)
+        accessions = (acc for acc in accessions if acc)
+        for batch in iter(lambda: list(islice(accessions, ACCESSIONS_PER_SEARCH)), []):
+            yield batch
+
+
+def process_experiment(ex_id, session, url, err, lock):
+    # frame=page is the embedded frame plus the audit, so award, replicates
+    # and files all come back in this one request
+    ex_request = session.get(urljoin(
+        url,
+        ex_id + '?frame=page&format=json'))
+    try:
+        ex = orjson.loads(ex_request.content)
+    except ValueError as e:
+        with lock:
+            err.write('{}\tValueError: {}\n'.format(ex_id, e))
+        return
+
+    if ex.get('status') != 'in progress':
+        return
+    assay_term_name = ex.get('assay_term_name')
+    exp_accession = ex.get('accession')
+    award_obj = ex.get('award') or {}
+    if not isinstance(award_obj, dict):
+        # the award is only a link when the frame doesn't embed it
+        award_obj = get_award(award_obj, session, url)
+    award_rfa = award_obj.get('rfa')
+    award_name = award_obj.get('name')
+    # excluding all modERN, ENCORE experiments
+    # and non ChIP modENCODE experiments from screening
+    if (
+        (assay_term_name not in MINIMAL_READ_DEPTH_REQUIREMENTS) or
+        (award_rfa == 'modERN') or (award_name == 'U41HG009889') or
+        (award_rfa == 'modENCODE' and assay_term_name != 'ChIP-seq')):
+        with lock:
+            err.write(
+                '{}\t{}\t{}\texcluded from automatic screening\n'.format(
+                    award_rfa,
+                    assay_term_name,
+                    exp_accession)
+            )
+        return
+
+    replicates = ex.get('replicates')
+    exp_files = ex.get('files')
+    if not replicates or not exp_files:
+        return
+    if not isinstance(replicates[0], dict):
+        # replicates came back as links, resolve them all in one search
+        replicates = search_linked_objects(
+            'Replicate', replicates,
+            ['@id', 'status', 'biological_replicate_number'],
+            session, url)
+    if not isinstance(exp_files[0], dict):
+        exp_files = search_linked_objects(
+            'File', exp_files,
+            ['@id', 'file_format', 'status', 'replicate', 'read_count',
+             'run_type', 'date_created'],
+            session, url)
+
+    replicates_set = set()
+    submitted_replicates = set()
+    replicates_reads = {}
+    bio_rep_reads = {}
+    replicates_bio_index = {}
+
+    for replicate_obj in replicates:
+        if replicate_obj.get('status') not in ['deleted']:
+            replicate_id = replicate_obj.get('@id')
+            replicates_set.add(replicate_id)
+            replicates_reads[replicate_id] = 0
+            replicates_bio_index[replicate_id] = replicate_obj.get('biological_replicate_number')
+            bio_rep_reads[replicates_bio_index[replicate_id]] = 0
+
+    dates = []
+    for file_obj in exp_files:
+        if file_obj.get('file_format') == 'fastq' and \
+           file_obj.get('status') not in ERRONEOUS_FILE_STATUSES:
+            replicate_id  = link_id(file_obj.get('replicate'))
+            read_count = file_obj.get('read_count')
+            if read_count and replicate_id:
+                submitted_replicates.add(replicate_id)
+                if replicate_id in replicates_reads:
+                    if file_obj.get('run_type') == 'paired-ended':
+                        read_count //= 2
+                    replicates_reads[replicate_id] += read_count
+                    bio_rep_reads[replicates_bio_index[replicate_id]] += read_count
+
+                    file_date = datetime.date.fromisoformat(
+                        file_obj['date_created'][:10])
+                    dates.append(file_date)
+
+    if not replicates_set or replicates_set - submitted_replicates:
+        return
+
+    key = assay_term_name
+    if award_rfa == 'modENCODE':
+        key = 'modENCODE-chip'
+        if assay_term_name in [
+            'DNase-seq',
+            'genetic modification followed by DNase-seq',
+            'ChIP-seq']:
+            replicates_reads = bio_rep_reads
+
+    for rep in replicates_reads:
+        if replicates_reads[rep] < MINIMAL_READ_DEPTH_REQUIREMENTS[key]:
+            # low read depth in replicate + details
+            with lock:
+                err.write(
+                    '{}\t{}\t{}\t{}\treads_count={}\texpected count={}\n'.format(
+                        award_rfa,
+                        assay_term_name,
+                        exp_accession,
+                        rep,
+                        replicates_reads[rep],
+                        MINIMAL_READ_DEPTH_REQUIREMENTS[key])
+                )
+            return
+
+    audit_obj = ex.get('audit') or {}
+    if audit_obj.get("ERROR"):
+        with lock:
+            err.write(
+                '{}\t{}\t{}\taudit errors\n'.format(
+                    award_rfa,
+                    assay_term_name,
+                    exp_accession)
+            )
+        return
+
+    submission_date = max(dates).strftime("%Y-%m-%d")
+    data = {
+        "status": "submitted",
+        "date_submitted": submission_date
+    }
+    report = '{}\t{}\t{}\t{}\t-> submitted\t{}\n'.format(
+        award_rfa,
+        assay_term_name,
+        exp_accession,
+        ex['status'],
+        submission_date)
+    return urljoin(url, exp_accession), data, report
+
+
+def check_experiment(ex_id, session, url, err, lock):
+    # the session adapter has already retried transient failures, so an
+    # error here means this experiment can't be checked on this run
+    try:
+        return process_experiment(ex_id, session, url, err, lock)
+    except requests.exceptions.RequestException as e:
+        print (e)
+
+
+def patch_experiment(session, item_url, data):
+    return session.patch(
+        item_url,
+        data=orjson.dumps(data),
+        headers=PATCH_HEADERS,
+    )
+
+
 def run(out, err, url, username, password, search_query, accessions_list=None, bot_token=None, dry_run=False):
-    session = requests.Session()
-    session.auth = (username, password)
-    session.headers['Accept'] = 'application/json'
+    session = make_session(username, password)
+
+    if bot_token:
+        # keep a copy of both logs for the Slack upload at the end
+        out = LogTee(out)
+        err = LogTee(err)
 
     dr = ""
     if dry_run:
@@ -29,16 +298,10 @@ def run(out, err, url, username, password, search_query, accessions_list=None, b
 
     version = '0.12'
 
-    try:
-        ip_output = subprocess.check_output(
-            ['hostname'], stderr=subprocess.STDOUT).strip()
-        ip = ip_output.decode(errors='replace').rstrip('\n')
-    except subprocess.CalledProcessError as e:
-        ip = ''
-
-    initiating_run = 'STARTING Checkexperiments version ' + \
-        '{} ({}) ({}): {} on {} at {}'.format(
-            version, url, search_query, dr, ip, datetime.datetime.now())
+    ip = socket.gethostname()
+
+    initiating_run = 'STARTING Checkexperiments version {} ({}) ({}): {} on {} at {}'.format(
+        version, url, search_query, dr, ip, datetime.datetime.now())
     out.write(initiating_run + '\nAward\tAccession\tcurrent status -> new status\tsubmitted date\n')
     out.flush()
     err.write(initiating_run + '\nAward\tAccession\terror message\n')
@@ -52,219 +315,64 @@ def run(out, err, url, username, password, search_query, accessions_list=None, b
             as_user=True
         )
 
-    # we don't have at the moment minimal requirements for ChIA and HiC
-    # that being the reason for specifying at least one read in each replicate
-    minimal_read_depth_requirements = {
-        'DNase-seq': 20000000,
-        'genetic modification followed by DNase-seq': 20000000,
-        'ChIP-seq': 20000000,
-        'RAMPAGE': 10000000,
-        'shRNA knockdown followed by RNA-seq': 10000000,
-        'siRNA knockdown followed by RNA-seq': 10000000,
-        'single cell isolation followed by RNA-seq': 10000000,
-        'CRISPR genome editing followed by RNA-seq': 10000000,
-        'modENCODE-chip': 500000,
-        'ChIA-PET': 1,
-        'HiC': 1
-    }
-
-
     graph = []
     # checkexperiments using a file with a list of experiment accessions to be checked
     if accessions_list:
-        r = None
-        ACCESSIONS = []
-        if os.path.isfile(accessions_list):
-            ACCESSIONS = [line.rstrip('\n') for line in open(accessions_list)]
-        for acc in ACCESSIONS:
-            r = session.get(
-                urljoin(url, '/search/?field=@id&frame=object&limit=all&type=Experiment&accession=' + acc))
+        # the search accepts repeated accession= parameters, so look the
+        # accessions up in batches rather than one request per accession
+        for batch in read_accession_batches(accessions_list):
+            params = [('accession', acc) for acc in batch]
+            params += [('type', 'Experiment'), ('field', '@id'), ('limit', 'all')]
+            params += screening_filters()
+            r = session.get(urljoin(url, '/search/'), params=params)
             try:
                 r.raise_for_status()
             except requests.HTTPError:
                 return
             else:
-                local = copy.deepcopy(r.json()['@graph'])
-                graph.extend(local)
+                graph.extend(orjson.loads(r.content)['@graph'])
     # checkexperiments using a query
     else:
         r = session.get(
             urljoin(
                 url,
                 '/search/?type=Experiment' \
-                '&format=json&frame=object&limit=all&' + search_query))
+                '&format=json&field=@id&limit=all&' + search_query),
+            params=screening_filters(search_query))
         try:
             r.raise_for_status()
         except requests.HTTPError:
             return
         else:
-            graph = r.json()['@graph']
-
-    for ex in graph:
-        if ex['status'] != 'in progress':
-            continue
-        assay_term_name = ex.get('assay_term_name')
-        exp_accession = ex.get('accession')
-        award_request = session.get(urljoin(
-            url,
-            ex.get('award') + '?frame=object&format=json'))
-        award_obj = award_request.json()
-        award_rfa = award_obj.get('rfa')
-        award_name = award_obj.get('name')
-        # excluding all modERN, ENCORE experiments
-        # and non ChIP modENCODE experiments from screening
-        if (
-            (assay_term_name not in minimal_read_depth_requirements) or
-            (award_rfa == 'modERN') or (award_name == 'U41HG009889') or
-            (award_rfa == 'modENCODE' and assay_term_name != 'ChIP-seq')):
-            err.write(
-                '{}\t{}\t{}\texcluded from automatic screening\n'.format(
-                    award_rfa,
-                    assay_term_name,
-                    exp_accession)
-            )                
-            err.flush()
-            continue
+            graph = orjson.loads(r.content)['@graph']
 
-        try:
-            replicates = ex.get('replicates')
-            if replicates:
-                replicates_set = set()
-                submitted_replicates = set()
-                replicates_reads = {}
-                bio_rep_reads = {}
-                replicates_bio_index = {}
-                
-                for replicate in replicates:
-                    replicate_request = session.get(urljoin(
-                        url,
-                        replicate + '?frame=object&format=json'))
-                    replicate_obj = replicate_request.json()
-                    if replicate_obj.get('status') not in ['deleted']:
-                        replicate_id = replicate_obj.get('@id')
-                        replicates_set.add(replicate_id)
-                        replicates_reads[replicate_id] = 0
-                        replicates_bio_index[replicate_id] = replicate_obj.get('biological_replicate_number')
-                        bio_rep_reads[replicates_bio_index[replicate_id]] = 0
-                exp_files = ex.get('files')
-                if  exp_files:
-                    erroneous_status = ['uploading', 'content error', 'upload failed']
-                    dates = []
-                    for file_acc in exp_files:
-                        file_request = session.get(urljoin(
-                            url,
-                            file_acc + '?frame=object&format=json'))
-                        file_obj = file_request.json()
-                        if file_obj.get('file_format') == 'fastq' and \
-                           file_obj.get('status') not in erroneous_status:
-                            replicate_id  = file_obj.get('replicate')
-                            read_count = file_obj.get('read_count')
-                            if read_count and replicate_id:
-                                submitted_replicates.add(replicate_id)
-                                if replicate_id in replicates_reads:
-                                    run_type = file_obj.get('run_type')
-                                    if run_type and run_type == 'paired-ended':
-                                        read_count == read_count/2
-                                    replicates_reads[replicate_id] += read_count
-                                    bio_rep_reads[replicates_bio_index[replicate_id]] += read_count
-
-                                    file_date = datetime.datetime.strptime(
-                                        file_obj['date_created'][:10], "%Y-%m-%d")
-                                    dates.append(file_date)
-                else:
-                    continue
+    lock = threading.Lock()
+    # each status update goes to the patcher as soon as its experiment is
+    # screened, and the ones already sent are reported even if a later
+    # experiment fails
+    patches = []
+    try:
+        with ThreadPoolExecutor(max_workers=PATCH_THREADS) as patcher, \
+                ThreadPoolExecutor(max_workers=16) as pool:
+            for pending_patch in pool.map(
+                    lambda ex: check_experiment(
+                        ex['@id'], session, url, err, lock),
+                    graph):
+                if pending_patch:
+                    patches.append((pending_patch, patcher.submit(
+                        patch_experiment, session, *pending_patch[:2])))
+    finally:
+        for (item_url, data, report), patch in patches:
+            try:
+                r = patch.result()
+            except requests.exceptions.RequestException as e:
+                print ('{} {}'.format(item_url, e))
             else:
-                continue
-        except requests.exceptions.RequestException as e:
-            print (e)
-            continue
-        else:
-            submitted_flag = True
-            if replicates_set and not replicates_set - submitted_replicates:
-                key = assay_term_name
-                if award_rfa == 'modENCODE':
-                    key = 'modENCODE-chip'
-                    if assay_term_name in [
-                        'DNase-seq',
-                        'genetic modification followed by DNase-seq',
-                        'ChIP-seq']:
-                        replicates_reads = bio_rep_reads
-                
-                for rep in replicates_reads:
-                    if replicates_reads[rep] < minimal_read_depth_requirements[key]:
-                        # low read depth in replicate + details
-                        submitted_flag = False
-                        err.write(
-                            '{}\t{}\t{}\t{}\treads_count={}\texpected count={}\n'.format(
-                                award_rfa,
-                                assay_term_name,
-                                exp_accession,
-                                rep,
-                                replicates_reads[rep],
-                                minimal_read_depth_requirements[key])
-                        )
-                        err.flush()
-                        break
-
-                if submitted_flag:
-                    pass_audit = True
-                    try:
-                        audit_request = session.get(urljoin(
-                            url,
-                            '/' + exp_accession + '?frame=page&format=json'))
-                        try:
-                            audit_obj = audit_request.json().get('audit')
-                        except ValueError as e:
-                            err.write('{}\t{}\t{}\tValueError: {}\n'.format(
-                                    award_rfa,
-                                    assay_term_name,
-                                    exp_accession, e)
-                            )
-                            err.flush()
-                        else:
-                            if audit_obj.get("ERROR"):
-                                pass_audit = False
-                    except requests.exceptions.RequestException as e:
-                        print (e)
-                        continue
-                    else:
-                        if pass_audit:
-                            submission_date = max(dates).strftime("%Y-%m-%d")
-                            item_url = urljoin(url, exp_accession)
-                            data = {
-                                "status": "submitted",
-                                "date_submitted": submission_date
-                            }
-                            r = session.patch(
-                                item_url,
-                                data=json.dumps(data),
-                                headers={
-                                    'content-type': 'application/json',
-                                    'accept': 'application/json'
-                                },
-                            )
-                            if not r.ok:
-                                print ('{} {}\n{}'.format(r.status_code, r.reason, r.text))
-                            else:
-                                out.write(
-                                    '{}\t{}\t{}\t{}\t-> submitted\t{}\n'.format(
-                                        award_rfa,
-                                        assay_term_name,
-                                        exp_accession,
-                                        ex['status'],
-                                        submission_date)
-                                )
-
-                            out.flush()
-                        else:
-                            err.write(
-                                '{}\t{}\t{}\taudit errors\n'.format(
-                                    award_rfa,
-                                    assay_term_name,
-                                    exp_accession)
-                            )
-
-                            err.flush()
+                if not r.ok:
+                    print ('{} {}\n{}'.format(r.status_code, r.reason, r.text))
+                else:
+                    out.write(report)
+        out.flush()
 
     finishing_run = 'FINISHED Checkexperiments at {}'.format(datetime.datetime.now())
     out.write(finishing_run + '\n')
@@ -275,26 +383,19 @@ def run(out, err, url, username, password, search_query, accessions_list=None, b
     err.close()
 
     if bot_token:
-        with open(output_filename, 'r') as output_file:
-            sc.api_call("files.upload",
-                        title=output_filename,
-                        channels='#bot-reporting',
-                        content=output_file.read(),
-                        as_user=True)
-
-        with open(error_filename, 'r') as output_file:
-            sc.api_call("files.upload",
-                        title=error_filename,
-                        channels='#bot-reporting',
-                        content=output_file.read(),
-                        as_user=True)
+        sc.api_call("files.upload",
+                    title=output_filename,
+                    channels='#bot-reporting',
+                    content=out.getvalue(),
+                    as_user=True)
 
-        sc.api_call(
-            "chat.postMessage",
-            channel="#bot-reporting",
-            text=finishing_run,
-            as_user=True
-        )
+        # the finishing message rides along with the last upload
+        sc.api_call("files.upload",
+                    title=error_filename,
+                    channels='#bot-reporting',
+                    content=err.getvalue(),
+                    initial_comment=finishing_run,
+                    as_user=True)
 
 def main():
     import argparse
@@ -310,10 +411,10 @@ def main():
         '--password', '-p', default='',
         help="HTTP password (secret_access_key)")
     parser.add_argument(
-        '--out', '-o', type=argparse.FileType('w'), default=sys.stdout,
+        '--out', '-o', type=argparse.FileType('w', LOG_BUFFER_SIZE), default=sys.stdout,
         help="file to write json lines of results with or without errors")
     parser.add_argument(
-        '--err', '-e', type=argparse.FileType('w'), default=sys.stderr,
+        '--err', '-e', type=argparse.FileType('w', LOG_BUFFER_SIZE), default=sys.stderr,
         help="file to write json lines of results with errors")
     parser.add_argument(
         '--dry-run', action='store_true', help="Don't update status, just check")
@@ -6,23 +6,69 @@ Example.
     %(prog)s --username ACCESS_KEY_ID --password SECRET_ACCESS_KEY \\
         --output check_files.log https://www.encodeproject.org
 """
+import collections
 import datetime
+import functools
+import gzip
+import hashlib
 import time
 import os.path
 import json
+import socket
 import sys
-from shlex import quote
 import subprocess
+import tempfile
 import re
-from urllib.parse import urljoin
+import threading
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from urllib.parse import urlencode, urljoin
+import orjson
 import requests
-import copy
-from slackclient import SlackClient
+from portal_session import make_session
 
 EPILOG = __doc__
 
 PYTHON_PATH = "/opt/encoded/checkfiles/venv/bin/python"
 
+# size of the reads taken from a decompressed FASTQ stream
+FASTQ_READ_SIZE = 1 << 20
+
+# size of the reads taken from a file being md5summed
+MD5_READ_SIZE = 1 << 20
+
+# number of portal objects kept by get_object before its cache is reset
+PORTAL_OBJECTS_CACHE_SIZE = 4096
+
+# number of @id parameters sent in one portal search
+IDS_PER_SEARCH = 100
+
+# longest fastq_signature= part of a search URL; signatures can hold whole
+# read names, so these searches are batched by length rather than count
+SIGNATURE_SEARCH_LENGTH = 4000
+
+# threads used to look up the platforms of the FASTQs a BAM derives from
+PLATFORM_LOOKUP_THREADS = 16
+
+# threads patching checked files on the portal while the pool keeps checking
+PATCH_THREADS = 8
+
+# Ultima platform uuid, its FASTQs are left out of read name checks
+ULTIMA_PLATFORM = '25acccbd-cb36-463b-ac96-adbac11227e6'
+
+# Pacbio, Nanopore and Ultima platform uuids, excluded from read length checks
+LONG_READ_PLATFORMS = frozenset([
+    'ced61406-dcc6-43c4-bddd-4c977cc676e8',
+    'c7564b38-ab4f-4c42-a401-3de48689a998',
+    'e2be5728-5744-4da4-8881-cb9526d0389e',
+    '7cc06b8c-5535-4a77-b719-4c23644e767d',
+    '8f1a9a8c-3392-4032-92a8-5d196c9d7810',
+    '6c275b37-018d-4bf8-85f6-6e3b830524a9',
+    '6ce511d5-eeb3-41fc-bea7-8c38301e88c1',
+    ULTIMA_PLATFORM,
+])
+
 # For submitters, bam files should not be submitted as .gz
 GZIP_TYPES = [
     "CEL",
@@ -45,30 +91,183 @@ GZIP_TYPES = [
 ]
 
 read_name_prefix = re.compile(
-    '^(@[a-zA-Z\d]+[a-zA-Z\d_-]*:[a-zA-Z\d-]+:[a-zA-Z\d_-]' +
-    '+:\d+:\d+:\d+:\d+)$')
+    r'^(@[a-zA-Z\d][a-zA-Z\d_-]*:[a-zA-Z\d-]+:[a-zA-Z\d_-]' +
+    r'+:\d+:\d+:\d+:\d+)$', re.ASCII)
 
 read_name_pattern = re.compile(
-    '^(@[a-zA-Z\d]+[a-zA-Z\d_-]*:[a-zA-Z\d-]+:[a-zA-Z\d_-]' +
-    '+:\d+:\d+:\d+:\d+[\s_][123]:[YXN]:[0-9]+:([ACNTG\+]*|[0-9]*))$'
+    r'^(@[a-zA-Z\d][a-zA-Z\d_-]*:[a-zA-Z\d-]+:[a-zA-Z\d_-]' +
+    r'+:\d+:\d+:\d+:\d+[\s_][123]:[YXN]:[0-9]+:([ACNTG\+]*|[0-9]*))$',
+    re.ASCII
 )
 
 special_read_name_pattern = re.compile(
-    '^(@[a-zA-Z\d]+[a-zA-Z\d_-]*:[a-zA-Z\d-]+:[a-zA-Z\d_-]' +
-    '+:\d+:\d+:\d+:\d+[/1|/2]*[\s_][123]:[YXN]:[0-9]+:([ACNTG\+]*|[0-9]*))$'
+    r'^(@[a-zA-Z\d][a-zA-Z\d_-]*:[a-zA-Z\d-]+:[a-zA-Z\d_-]' +
+    r'+:\d+:\d+:\d+:\d+[/12|]*[\s_][123]:[YXN]:[0-9]+:([ACNTG\+]*|[0-9]*))$',
+    re.ASCII
 )
 
 srr_read_name_pattern = re.compile(
-    '^(@SRR[\d.]+)$'
+    r'^(@SRR[\d.]+)$',
+    re.ASCII
 )
 
 pacbio_read_name_pattern = re.compile(
-    '^(@m\d{6}_\d{6}_\d+_[a-zA-Z\d_-]+\/.*)$|^(@m\d+U?_\d{6}_\d{6}\/.*)$|^(@c.+)$'
+    r'^(@m\d{6}_\d{6}_\d+_[a-zA-Z\d_-]+\/.*)$|^(@m\d+U?_\d{6}_\d{6}\/.*)$|^(@c.+)$',
+    re.ASCII
 )
 
+md5sum_pattern = re.compile(r'[0-9a-f]{32}', re.ASCII)
+match_md5sum = md5sum_pattern.fullmatch
+
+# translation tables that fold read-name delimiters into ':' (or ' ') so that
+# str.split gives the same fields as re.split on the delimiter class
+illumina_read_name_delimiters = str.maketrans(' \t\n\r\f\v_', ':' * 7)
+read_name_delimiters = str.maketrans(' \t\n\r\f\v', ':' * 6)
+read_name_whitespace = str.maketrans('\t\n\r\f\v', ' ' * 5)
+
+# bound match methods for the per-read path in process_read_name_line
+match_read_name_prefix = read_name_prefix.match
+match_read_name = read_name_pattern.match
+match_special_read_name = special_read_name_pattern.match
+match_srr_read_name = srr_read_name_pattern.match
+match_pacbio_read_name = pacbio_read_name_pattern.match
+
+ASSEMBLY_MAP = {
+    'GRCh38-minimal': 'GRCh38',
+    'mm10-minimal': 'mm10'
+}
+
+# placeholder for the per-file -chromInfo argument in the validate map
+CHROM_INFO = object()
+
+
+@functools.lru_cache(maxsize=None)
+def get_validate_map(encValData):
+    """ validateFiles arguments by (file_format, file_format_type), built
+    once per encValData location
+    """
+    return {
+        ('fasta', None): ['-type=fasta'],
+        ('fastq', None): ['-type=fastq'],
+        ('bam', None): ['-type=bam', CHROM_INFO],
+        ('bigWig', None): ['-type=bigWig', CHROM_INFO],
+        ('bigInteract', None): ['-type=bigBed5+13', CHROM_INFO, '-as=%s/as/interact.as' % encValData],
+        # standard bed formats
+        ('bed', 'bed3'): ['-type=bed3', CHROM_INFO],
+        ('bigBed', 'bed3'): ['-type=bigBed3', CHROM_INFO],
+        ('bed', 'bed5'): ['-type=bed5', CHROM_INFO],
+        ('bigBed', 'bed5'): ['-type=bigBed5', CHROM_INFO],
+        ('bed', 'bed6'): ['-type=bed6', CHROM_INFO],
+        ('bigBed', 'bed6'): ['-type=bigBed6', CHROM_INFO],
+        ('bed', 'bed9'): ['-type=bed9', CHROM_INFO],
+        ('bigBed', 'bed9'): ['-type=bigBed9', CHROM_INFO],
+        ('bedGraph', None): ['-type=bedGraph', CHROM_INFO],
+        # extended "bed+" formats, -tab is required to allow for text fields to contain spaces
+        ('bed', 'bed3+'): ['-tab', '-type=bed3+', CHROM_INFO],
+        ('bigBed', 'bed3+'): ['-tab', '-type=bigBed3+', CHROM_INFO],
+        ('bed', 'bed6+'): ['-tab', '-type=bed6+', CHROM_INFO],
+        ('bigBed', 'bed6+'): ['-tab', '-type=bigBed6+', CHROM_INFO],
+        ('bed', 'bed9+'): ['-tab', '-type=bed9+', CHROM_INFO],
+        ('bigBed', 'bed9+'): ['-tab', '-type=bigBed9+', CHROM_INFO],
+        # a catch-all shoe-horn (as long as it's tab-delimited)
+        ('bed', 'unknown'): ['-tab', '-type=bed3+', CHROM_INFO],
+        ('bigBed', 'unknown'): ['-tab', '-type=bigBed3+', CHROM_INFO],
+        # special bed types
+        ('bed', 'bedLogR'): ['-type=bed9+1', CHROM_INFO, '-as=%s/as/bedLogR.as' % encValData],
+        ('bigBed', 'bedLogR'): ['-type=bigBed9+1', CHROM_INFO, '-as=%s/as/bedLogR.as' % encValData],
+        ('bed', 'bedMethyl'): ['-type=bed9+2', CHROM_INFO, '-as=%s/as/bedMethyl.as' % encValData],
+        ('bigBed', 'bedMethyl'): ['-type=bigBed9+2', CHROM_INFO, '-as=%s/as/bedMethyl.as' % encValData],
+        ('bed', 'broadPeak'): ['-type=bed6+3', CHROM_INFO, '-as=%s/as/broadPeak.as' % encValData],
+        ('bigBed', 'broadPeak'): ['-type=bigBed6+3', CHROM_INFO, '-as=%s/as/broadPeak.as' % encValData],
+        ('bed', 'gappedPeak'): ['-type=bed12+3', CHROM_INFO, '-as=%s/as/gappedPeak.as' % encValData],
+        ('bigBed', 'gappedPeak'): ['-type=bigBed12+3', CHROM_INFO, '-as=%s/as/gappedPeak.as' % encValData],
+        ('bed', 'narrowPeak'): ['-type=bed6+4', CHROM_INFO, '-as=%s/as/narrowPeak.as' % encValData],
+        ('bigBed', 'narrowPeak'): ['-type=bigBed6+4', CHROM_INFO, '-as=%s/as/narrowPeak.as' % encValData],
+        ('bed', 'bedRnaElements'): ['-type=bed6+3', CHROM_INFO, '-as=%s/as/bedRnaElements.as' % encValData],
+        ('bigBed', 'bedRnaElements'): ['-type=bed6+3', CHROM_INFO, '-as=%s/as/bedRnaElements.as' % encValData],
+        ('bed', 'bedExonScore'): ['-type=bed6+3', CHROM_INFO, '-as=%s/as/bedExonScore.as' % encValData],
+        ('bigBed', 'bedExonScore'): ['-type=bigBed6+3', CHROM_INFO, '-as=%s/as/bedExonScore.as' % encValData],
+        ('bed', 'bedRrbs'): ['-type=bed9+2', CHROM_INFO, '-as=%s/as/bedRrbs.as' % encValData],
+        ('bigBed', 'bedRrbs'): ['-type=bigBed9+2', CHROM_INFO, '-as=%s/as/bedRrbs.as' % encValData],
+        ('bed', 'enhancerAssay'): ['-type=bed9+1', CHROM_INFO, '-as=%s/as/enhancerAssay.as' % encValData],
+        ('bigBed', 'enhancerAssay'): ['-type=bigBed9+1', CHROM_INFO, '-as=%s/as/enhancerAssay.as' % encValData],
+        ('bed', 'modPepMap'): ['-type=bed9+7', CHROM_INFO, '-as=%s/as/modPepMap.as' % encValData],
+        ('bigBed', 'modPepMap'): ['-type=bigBed9+7', CHROM_INFO, '-as=%s/as/modPepMap.as' % encValData],
+        ('bed', 'pepMap'): ['-type=bed9+7', CHROM_INFO, '-as=%s/as/pepMap.as' % encValData],
+        ('bigBed', 'pepMap'): ['-type=bigBed9+7', CHROM_INFO, '-as=%s/as/pepMap.as' % encValData],
+        ('bed', 'openChromCombinedPeaks'): ['-type=bed9+12', CHROM_INFO, '-as=%s/as/openChromCombinedPeaks.as' % encValData],
+        ('bigBed', 'openChromCombinedPeaks'): ['-type=bigBed9+12', CHROM_INFO, '-as=%s/as/openChromCombinedPeaks.as' % encValData],
+        ('bed', 'peptideMapping'): ['-type=bed6+4', CHROM_INFO, '-as=%s/as/peptideMapping.as' % encValData],
+        ('bigBed', 'peptideMapping'): ['-type=bigBed6+4', CHROM_INFO, '-as=%s/as/peptideMapping.as' % encValData],
+        ('bed', 'shortFrags'): ['-type=bed6+21', CHROM_INFO, '-as=%s/as/shortFrags.as' % encValData],
+        ('bigBed', 'shortFrags'): ['-type=bigBed6+21', CHROM_INFO, '-as=%s/as/shortFrags.as' % encValData],
+        ('bed', 'encode_elements_H3K27ac'): ['-tab', '-type=bed9+1', CHROM_INFO, '-as=%s/as/encode_elements_H3K27ac.as' % encValData],
+        ('bigBed', 'encode_elements_H3K27ac'): ['-tab', '-type=bigBed9+1', CHROM_INFO, '-as=%s/as/encode_elements_H3K27ac.as' % encValData],
+        ('bed', 'encode_elements_H3K9ac'): ['-tab', '-type=bed9+1', CHROM_INFO, '-as=%s/as/encode_elements_H3K9ac.as' % encValData],
+        ('bigBed', 'encode_elements_H3K9ac'): ['-tab', '-type=bigBed9+1', CHROM_INFO, '-as=%s/as/encode_elements_H3K9ac.as' % encValData],
+        ('bed', 'encode_elements_H3K4me1'): ['-tab', '-type=bed9+1', CHROM_INFO, '-as=%s/as/encode_elements_H3K4me1.as' % encValData],
+        ('bigBed', 'encode_elements_H3K4me1'): ['-tab', '-type=bigBed9+1', CHROM_INFO, '-as=%s/as/encode_elements_H3K4me1.as' % encValData],
+        ('bed', 'encode_elements_H3K4me3'): ['-tab', '-type=bed9+1', CHROM_INFO, '-as=%s/as/encode_elements_H3K4me3.as' % encValData],
+        ('bigBed', 'encode_elements_H3K4me3'): ['-tab', '-type=bigBed9+1', CHROM_INFO, '-as=%s/as/encode_elements_H3K4me3.as' % encValData],
+        ('bed', 'dnase_master_peaks'): ['-tab', '-type=bed9+1', CHROM_INFO, '-as=%s/as/dnase_master_peaks.as' % encValData],
+        ('bigBed', 'dnase_master_peaks'): ['-tab', '-type=bigBed9+1', CHROM_INFO, '-as=%s/as/dnase_master_peaks.as' % encValData],
+        ('bed', 'encode_elements_dnase_tf'): ['-tab', '-type=bed5+1', CHROM_INFO, '-as=%s/as/encode_elements_dnase_tf.as' % encValData],
+        ('bigBed', 'encode_elements_dnase_tf'): ['-tab', '-type=bigBed5+1', CHROM_INFO, '-as=%s/as/encode_elements_dnase_tf.as' % encValData],
+        ('bed', 'candidate enhancer predictions'): ['-type=bed3+', CHROM_INFO, '-as=%s/as/candidate_enhancer_prediction.as' % encValData],
+        ('bigBed', 'candidate enhancer predictions'): ['-type=bigBed3+', CHROM_INFO, '-as=%s/as/candidate_enhancer_prediction.as' % encValData],
+        ('bed', 'enhancer predictions'): ['-type=bed3+', CHROM_INFO, '-as=%s/as/enhancer_prediction.as' % encValData],
+        ('bigBed', 'enhancer predictions'): ['-type=bigBed3+', CHROM_INFO, '-as=%s/as/enhancer_prediction.as' % encValData],
+        ('bed', 'idr_peak'): ['-type=bed6+', CHROM_INFO, '-as=%s/as/idr_peak.as' % encValData],
+        ('bigBed', 'idr_peak'): ['-type=bigBed6+', CHROM_INFO, '-as=%s/as/idr_peak.as' % encValData],
+        ('bed', 'tss_peak'): ['-type=bed6+', CHROM_INFO, '-as=%s/as/tss_peak.as' % encValData],
+        ('bigBed', 'tss_peak'): ['-type=bigBed6+', CHROM_INFO, '-as=%s/as/tss_peak.as' % encValData],
+        ('bed', 'idr_ranked_peak'): ['-type=bed6+14', CHROM_INFO, '-as=%s/as/idr_ranked_peak.as' % encValData],
+        ('bed', 'element enrichments'): ['-type=bed6+5', CHROM_INFO, '-as=%s/as/mpra_starr.as' % encValData],
+        ('bigBed', 'element enrichments'): ['-type=bigBed6+5', CHROM_INFO, '-as=%s/as/mpra_starr.as' % encValData],
+        ('bed', 'CRISPR element quantifications'): ['-type=bed3+22', CHROM_INFO, '-as=%s/as/element_quant_format.as' % encValData],
+        
+        ('bedpe', None): ['-type=bed3+', CHROM_INFO],
+        ('bedpe', 'mango'): ['-type=bed3+', CHROM_INFO],
+        # non-bed types
+        ('rcc', None): ['-type=rcc'],
+        ('idat', None): ['-type=idat'],
+        ('gtf', None): None,
+        ('tagAlign', None): ['-type=tagAlign', CHROM_INFO],
+        ('tar', None): None,
+        ('tsv', None): None,
+        ('csv', None): None,
+        ('2bit', None): None,
+        ('csfasta', None): ['-type=csfasta'],
+        ('csqual', None): ['-type=csqual'],
+        ('CEL', None): None,
+        ('sam', None): None,
+        ('wig', None): None,
+        ('hdf5', None): None,
+        ('hic', None): None,
+        ('gff', None): None,
+        ('vcf', None): None,
+        ('btr', None): None
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def get_validate_args(encValData, file_format, file_format_type, chromInfo):
+    """ validateFiles arguments for one file format with the -chromInfo
+    argument filled in, or None when the format is not validated
+    """
+    validate_args = get_validate_map(encValData).get((file_format, file_format_type))
+    if validate_args is None:
+        return None
+    return tuple(chromInfo if arg is CHROM_INFO else arg for arg in validate_args)
+
+
 def is_path_gzipped(path):
-    with open(path, 'rb') as f:
-        magic_number = f.read(2)
+    # unbuffered read, there is no need for a file object to get two bytes
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        magic_number = os.read(fd, 2)
+    finally:
+        os.close(fd)
     return magic_number == b'\x1f\x8b'
 
 
@@ -82,11 +281,6 @@ def update_content_error(errors, error_message):
 def check_format(encValData, job, path):
     """ Local validation
     """
-    ASSEMBLY_MAP = {
-        'GRCh38-minimal': 'GRCh38',
-        'mm10-minimal': 'mm10'
-    }
-
     errors = job['errors']
     item = job['item']
     result = job['result']
@@ -120,144 +314,53 @@ def check_format(encValData, job, path):
     else:
         chromInfo = '-chromInfo={}/{}/chrom.sizes'.format(encValData, assembly)
 
-    validate_map = {
-        ('fasta', None): ['-type=fasta'],
-        ('fastq', None): ['-type=fastq'],
-        ('bam', None): ['-type=bam', chromInfo],
-        ('bigWig', None): ['-type=bigWig', chromInfo],
-        ('bigInteract', None): ['-type=bigBed5+13', chromInfo, '-as=%s/as/interact.as' % encValData],
-        # standard bed formats
-        ('bed', 'bed3'): ['-type=bed3', chromInfo],
-        ('bigBed', 'bed3'): ['-type=bigBed3', chromInfo],
-        ('bed', 'bed5'): ['-type=bed5', chromInfo],
-        ('bigBed', 'bed5'): ['-type=bigBed5', chromInfo],
-        ('bed', 'bed6'): ['-type=bed6', chromInfo],
-        ('bigBed', 'bed6'): ['-type=bigBed6', chromInfo],
-        ('bed', 'bed9'): ['-type=bed9', chromInfo],
-        ('bigBed', 'bed9'): ['-type=bigBed9', chromInfo],
-        ('bedGraph', None): ['-type=bedGraph', chromInfo],
-        # extended "bed+" formats, -tab is required to allow for text fields to contain spaces
-        ('bed', 'bed3+'): ['-tab', '-type=bed3+', chromInfo],
-        ('bigBed', 'bed3+'): ['-tab', '-type=bigBed3+', chromInfo],
-        ('bed', 'bed6+'): ['-tab', '-type=bed6+', chromInfo],
-        ('bigBed', 'bed6+'): ['-tab', '-type=bigBed6+', chromInfo],
-        ('bed', 'bed9+'): ['-tab', '-type=bed9+', chromInfo],
-        ('bigBed', 'bed9+'): ['-tab', '-type=bigBed9+', chromInfo],
-        # a catch-all shoe-horn (as long as it's tab-delimited)
-        ('bed', 'unknown'): ['-tab', '-type=bed3+', chromInfo],
-        ('bigBed', 'unknown'): ['-tab', '-type=bigBed3+', chromInfo],
-        # special bed types
-        ('bed', 'bedLogR'): ['-type=bed9+1', chromInfo, '-as=%s/as/bedLogR.as' % encValData],
-        ('bigBed', 'bedLogR'): ['-type=bigBed9+1', chromInfo, '-as=%s/as/bedLogR.as' % encValData],
-        ('bed', 'bedMethyl'): ['-type=bed9+2', chromInfo, '-as=%s/as/bedMethyl.as' % encValData],
-        ('bigBed', 'bedMethyl'): ['-type=bigBed9+2', chromInfo, '-as=%s/as/bedMethyl.as' % encValData],
-        ('bed', 'broadPeak'): ['-type=bed6+3', chromInfo, '-as=%s/as/broadPeak.as' % encValData],
-        ('bigBed', 'broadPeak'): ['-type=bigBed6+3', chromInfo, '-as=%s/as/broadPeak.as' % encValData],
-        ('bed', 'gappedPeak'): ['-type=bed12+3', chromInfo, '-as=%s/as/gappedPeak.as' % encValData],
-        ('bigBed', 'gappedPeak'): ['-type=bigBed12+3', chromInfo, '-as=%s/as/gappedPeak.as' % encValData],
-        ('bed', 'narrowPeak'): ['-type=bed6+4', chromInfo, '-as=%s/as/narrowPeak.as' % encValData],
-        ('bigBed', 'narrowPeak'): ['-type=bigBed6+4', chromInfo, '-as=%s/as/narrowPeak.as' % encValData],
-        ('bed', 'bedRnaElements'): ['-type=bed6+3', chromInfo, '-as=%s/as/bedRnaElements.as' % encValData],
-        ('bigBed', 'bedRnaElements'): ['-type=bed6+3', chromInfo, '-as=%s/as/bedRnaElements.as' % encValData],
-        ('bed', 'bedExonScore'): ['-type=bed6+3', chromInfo, '-as=%s/as/bedExonScore.as' % encValData],
-        ('bigBed', 'bedExonScore'): ['-type=bigBed6+3', chromInfo, '-as=%s/as/bedExonScore.as' % encValData],
-        ('bed', 'bedRrbs'): ['-type=bed9+2', chromInfo, '-as=%s/as/bedRrbs.as' % encValData],
-        ('bigBed', 'bedRrbs'): ['-type=bigBed9+2', chromInfo, '-as=%s/as/bedRrbs.as' % encValData],
-        ('bed', 'enhancerAssay'): ['-type=bed9+1', chromInfo, '-as=%s/as/enhancerAssay.as' % encValData],
-        ('bigBed', 'enhancerAssay'): ['-type=bigBed9+1', chromInfo, '-as=%s/as/enhancerAssay.as' % encValData],
-        ('bed', 'modPepMap'): ['-type=bed9+7', chromInfo, '-as=%s/as/modPepMap.as' % encValData],
-        ('bigBed', 'modPepMap'): ['-type=bigBed9+7', chromInfo, '-as=%s/as/modPepMap.as' % encValData],
-        ('bed', 'pepMap'): ['-type=bed9+7', chromInfo, '-as=%s/as/pepMap.as' % encValData],
-        ('bigBed', 'pepMap'): ['-type=bigBed9+7', chromInfo, '-as=%s/as/pepMap.as' % encValData],
-        ('bed', 'openChromCombinedPeaks'): ['-type=bed9+12', chromInfo, '-as=%s/as/openChromCombinedPeaks.as' % encValData],
-        ('bigBed', 'openChromCombinedPeaks'): ['-type=bigBed9+12', chromInfo, '-as=%s/as/openChromCombinedPeaks.as' % encValData],
-        ('bed', 'peptideMapping'): ['-type=bed6+4', chromInfo, '-as=%s/as/peptideMapping.as' % encValData],
-        ('bigBed', 'peptideMapping'): ['-type=bigBed6+4', chromInfo, '-as=%s/as/peptideMapping.as' % encValData],
-        ('bed', 'shortFrags'): ['-type=bed6+21', chromInfo, '-as=%s/as/shortFrags.as' % encValData],
-        ('bigBed', 'shortFrags'): ['-type=bigBed6+21', chromInfo, '-as=%s/as/shortFrags.as' % encValData],
-        ('bed', 'encode_elements_H3K27ac'): ['-tab', '-type=bed9+1', chromInfo, '-as=%s/as/encode_elements_H3K27ac.as' % encValData],
-        ('bigBed', 'encode_elements_H3K27ac'): ['-tab', '-type=bigBed9+1', chromInfo, '-as=%s/as/encode_elements_H3K27ac.as' % encValData],
-        ('bed', 'encode_elements_H3K9ac'): ['-tab', '-type=bed9+1', chromInfo, '-as=%s/as/encode_elements_H3K9ac.as' % encValData],
-        ('bigBed', 'encode_elements_H3K9ac'): ['-tab', '-type=bigBed9+1', chromInfo, '-as=%s/as/encode_elements_H3K9ac.as' % encValData],
-        ('bed', 'encode_elements_H3K4me1'): ['-tab', '-type=bed9+1', chromInfo, '-as=%s/as/encode_elements_H3K4me1.as' % encValData],
-        ('bigBed', 'encode_elements_H3K4me1'): ['-tab', '-type=bigBed9+1', chromInfo, '-as=%s/as/encode_elements_H3K4me1.as' % encValData],
-        ('bed', 'encode_elements_H3K4me3'): ['-tab', '-type=bed9+1', chromInfo, '-as=%s/as/encode_elements_H3K4me3.as' % encValData],
-        ('bigBed', 'encode_elements_H3K4me3'): ['-tab', '-type=bigBed9+1', chromInfo, '-as=%s/as/encode_elements_H3K4me3.as' % encValData],
-        ('bed', 'dnase_master_peaks'): ['-tab', '-type=bed9+1', chromInfo, '-as=%s/as/dnase_master_peaks.as' % encValData],
-        ('bigBed', 'dnase_master_peaks'): ['-tab', '-type=bigBed9+1', chromInfo, '-as=%s/as/dnase_master_peaks.as' % encValData],
-        ('bed', 'encode_elements_dnase_tf'): ['-tab', '-type=bed5+1', chromInfo, '-as=%s/as/encode_elements_dnase_tf.as' % encValData],
-        ('bigBed', 'encode_elements_dnase_tf'): ['-tab', '-type=bigBed5+1', chromInfo, '-as=%s/as/encode_elements_dnase_tf.as' % encValData],
-        ('bed', 'candidate enhancer predictions'): ['-type=bed3+', chromInfo, '-as=%s/as/candidate_enhancer_prediction.as' % encValData],
-        ('bigBed', 'candidate enhancer predictions'): ['-type=bigBed3+', chromInfo, '-as=%s/as/candidate_enhancer_prediction.as' % encValData],
-        ('bed', 'enhancer predictions'): ['-type=bed3+', chromInfo, '-as=%s/as/enhancer_prediction.as' % encValData],
-        ('bigBed', 'enhancer predictions'): ['-type=bigBed3+', chromInfo, '-as=%s/as/enhancer_prediction.as' % encValData],
-        ('bed', 'idr_peak'): ['-type=bed6+', chromInfo, '-as=%s/as/idr_peak.as' % encValData],
-        ('bigBed', 'idr_peak'): ['-type=bigBed6+', chromInfo, '-as=%s/as/idr_peak.as' % encValData],
-        ('bed', 'tss_peak'): ['-type=bed6+', chromInfo, '-as=%s/as/tss_peak.as' % encValData],
-        ('bigBed', 'tss_peak'): ['-type=bigBed6+', chromInfo, '-as=%s/as/tss_peak.as' % encValData],
-        ('bed', 'idr_ranked_peak'): ['-type=bed6+14', chromInfo, '-as=%s/as/idr_ranked_peak.as' % encValData],
-        ('bed', 'element enrichments'): ['-type=bed6+5', chromInfo, '-as=%s/as/mpra_starr.as' % encValData],
-        ('bigBed', 'element enrichments'): ['-type=bigBed6+5', chromInfo, '-as=%s/as/mpra_starr.as' % encValData],
-        ('bed', 'CRISPR element quantifications'): ['-type=bed3+22', chromInfo, '-as=%s/as/element_quant_format.as' % encValData],
-        
-        ('bedpe', None): ['-type=bed3+', chromInfo],
-        ('bedpe', 'mango'): ['-type=bed3+', chromInfo],
-        # non-bed types
-        ('rcc', None): ['-type=rcc'],
-        ('idat', None): ['-type=idat'],
-        ('gtf', None): None,
-        ('tagAlign', None): ['-type=tagAlign', chromInfo],
-        ('tar', None): None,
-        ('tsv', None): None,
-        ('csv', None): None,
-        ('2bit', None): None,
-        ('csfasta', None): ['-type=csfasta'],
-        ('csqual', None): ['-type=csqual'],
-        ('CEL', None): None,
-        ('sam', None): None,
-        ('wig', None): None,
-        ('hdf5', None): None,
-        ('hic', None): None,
-        ('gff', None): None,
-        ('vcf', None): None,
-        ('btr', None): None
-    }
-
     if not subreads:
-        # samtools quickcheck
+        # samtools quickcheck and validateFiles read the same file independently,
+        # so both are started before either result is collected
+        quickcheck = None
         if item.get('file_format') == 'bam':
-            try:
-                output = subprocess.check_output(
-                    ['samtools', 'quickcheck', path], stderr=subprocess.STDOUT)
-            except subprocess.CalledProcessError as e:
-                errors['bamValidation'] = e.output.decode(errors='replace').rstrip('\n')
+            quickcheck = subprocess.Popen(
+                ['samtools', 'quickcheck', path],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        # validateFiles
+        validate_files = None
+        missing_assembly = False
+        validate_args = get_validate_args(
+            encValData, item['file_format'], item.get('file_format_type'), chromInfo)
+        if validate_args is not None:
+            if chromInfo in validate_args and 'assembly' not in item:
+                missing_assembly = True
+            else:
+                result['validateFiles_args'] = ' '.join(validate_args)
+                validate_files = subprocess.Popen(
+                    ['validateFiles', *validate_args, path],
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        if quickcheck is not None:
+            # only a failing quickcheck has anything to say, and says it on stderr
+            output, error = quickcheck.communicate()
+            if quickcheck.returncode:
+                errors['bamValidation'] = error.decode(errors='replace').rstrip('\n')
                 update_content_error(errors, 'File failed bam validation ' +
                                             '(samtools quickcheck). ' + errors['bamValidation'])
             else:
                 result['bamValidation'] = output.decode(errors='replace').rstrip('\n')
 
-        # validateFiles
-        validate_args = validate_map.get((item['file_format'], item.get('file_format_type')))
-        if validate_args is None:
-            return
-
-        if chromInfo in validate_args and 'assembly' not in item:
+        if missing_assembly:
             errors['assembly'] = 'missing assembly'
             update_content_error(errors, 'File metadata lacks assembly information')
             return
 
-        result['validateFiles_args'] = ' '.join(validate_args)
+        if validate_files is not None:
+            output = validate_files.communicate()[0].decode(errors='replace').rstrip('\n')
+            if validate_files.returncode:
+                errors['validateFiles'] = output
+                update_content_error(errors, 'File failed file format specific ' +
+                                             'validation (encValData) ' + errors['validateFiles'])
+            else:
+                result['validateFiles'] = output
 
-    
-        try:
-            output = subprocess.check_output(
-                ['validateFiles'] + validate_args + [path], stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            errors['validateFiles'] = e.output.decode(errors='replace').rstrip('\n')
-            update_content_error(errors, 'File failed file format specific ' +
-                                         'validation (encValData) ' + errors['validateFiles'])
-        else:
-            result['validateFiles'] = output.decode(errors='replace').rstrip('\n')
 
 def validate_crispr(job, filePath):
     '''
@@ -274,82 +377,83 @@ def validate_crispr(job, filePath):
     genome_reference_path  = '/opt/GRCh38_no_alt_analysis_set_GCA_000001405.15.fasta'
 
     try:
-        output = subprocess.Popen(  
-                            [PYTHON_PATH, guide_validationScript_path,
-                            guide_format_path, filePath],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                            universal_newlines=True)
-        
         checkPAM = False
-        for line in output.stdout.readlines():
-            line = line.strip()
-            
-            try:
-                assert('passed' in line)
-                checkPAM = True
-
-            except AssertionError:
-                errors['CRISPR_guide_quant_validation'] = line
-                update_content_error(errors, 'File failed CRISPR guide quantification format validation ' +
-                                            '(check_guide_quant_format.py). ' + errors['CRISPR_guide_quant_validation'])
-            else:
-                result['CRISPR_guide_quant_validation'] = line
+        with subprocess.Popen(
+                [PYTHON_PATH, guide_validationScript_path,
+                 guide_format_path, filePath],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                universal_newlines=True) as output:
+            for line in output.stdout:
+                line = line.strip()
+
+                if 'passed' in line:
+                    checkPAM = True
+                    result['CRISPR_guide_quant_validation'] = line
+                else:
+                    errors['CRISPR_guide_quant_validation'] = line
+                    update_content_error(errors, 'File failed CRISPR guide quantification format validation ' +
+                                                '(check_guide_quant_format.py). ' + errors['CRISPR_guide_quant_validation'])
       
         if checkPAM:
             try:
-                output = subprocess.Popen(  
-                                [PYTHON_PATH, pam_validationScript_path,
-                                filePath,
-                                genome_reference_path],
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                universal_newlines=True)
-
-                count = 0
-                for line in output.stdout.readlines():
-                    line  = line.strip()
-                    if count == 3:
-                        try:
-                            assert('More than 80% of the PAMs are NGG. The coordinates are likely to be correct' in line)
-
-                        except AssertionError:
-                            errors['CRISPR_PAM_validation'] = line
-                            update_content_error(errors, 'File failed CRISPR PAM validation ' +
-                                            '(check_PAM.py). ' + errors['CRISPR_PAM_validation'])
-                        else:
-                            result['CRISPR_PAM_validation'] = line
-                    count+=1
+                with subprocess.Popen(
+                        [PYTHON_PATH, pam_validationScript_path,
+                         filePath,
+                         genome_reference_path],
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.DEVNULL,
+                        universal_newlines=True) as output:
+                    count = 0
+                    for line in output.stdout:
+                        line  = line.strip()
+                        if count == 3:
+                            if 'More than 80% of the PAMs are NGG. The coordinates are likely to be correct' in line:
+                                result['CRISPR_PAM_validation'] = line
+                            else:
+                                errors['CRISPR_PAM_validation'] = line
+                                update_content_error(errors, 'File failed CRISPR PAM validation ' +
+                                                '(check_PAM.py). ' + errors['CRISPR_PAM_validation'])
+                        count+=1
 
             except subprocess.CalledProcessError as e:
                 errors['CRISPR_PAM_info_extraction'] = 'Failed to extract information from ' + \
-                                                            local_path
+                                                            filePath
             
     except subprocess.CalledProcessError as e:
         errors['CRISPR_guide_info_extraction'] = 'Failed to extract information from ' + \
-                                                            local_path
+                                                            filePath
     
 
+@functools.lru_cache(maxsize=256)
+def get_signatures(flowcell, lane_number, read_number, barcode_index):
+    """ Signature strings, with and without the barcode, for one
+    flowcell:lane:read:barcode combination. A FASTQ repeats a handful of
+    these for every read, so the cached strings (and their cached hashes)
+    are reused rather than rebuilt per read.
+    """
+    return (f'{flowcell}:{lane_number}:{read_number}:{barcode_index}:',
+            f'{flowcell}:{lane_number}:{read_number}:')
+
+
 def process_illumina_read_name_pattern(read_name,
                                        read_numbers_set,
                                        signatures_set,
                                        signatures_no_barcode_set,
                                        srr_flag):
-    read_name_array = re.split(r'[:\s_]', read_name)
+    read_name_array = read_name.translate(illumina_read_name_delimiters).split(':')
     flowcell = read_name_array[2]
     lane_number = read_name_array[3]
     if srr_flag:
-        read_number = list(read_numbers_set)[0]
+        read_number = next(iter(read_numbers_set))
     else:
         read_number = read_name_array[-4]
         read_numbers_set.add(read_number)
     barcode_index = read_name_array[-1]
-    signatures_set.add(
-        flowcell + ':' + lane_number + ':' +
-        read_number + ':' + barcode_index + ':')
-    signatures_no_barcode_set.add(
-        flowcell + ':' + lane_number + ':' +
-        read_number + ':')
+    signature, signature_no_barcode = get_signatures(
+        flowcell, lane_number, read_number, barcode_index)
+    signatures_set.add(signature)
+    signatures_no_barcode_set.add(signature_no_barcode)
 
 
 def process_special_read_name_pattern(read_name,
@@ -359,23 +463,21 @@ def process_special_read_name_pattern(read_name,
                                       read_numbers_set,
                                       srr_flag):
     if srr_flag:
-        read_number = list(read_numbers_set)[0]
+        read_number = next(iter(read_numbers_set))
     else:
         read_number = 'not initialized'
         if len(words_array[0]) > 3 and \
            words_array[0][-2:] in ['/1', '/2']:
             read_number = words_array[0][-1]
             read_numbers_set.add(read_number)
-    read_name_array = re.split(r'[:\s_]', read_name)
+    read_name_array = read_name.translate(illumina_read_name_delimiters).split(':')
     flowcell = read_name_array[2]
     lane_number = read_name_array[3]
     barcode_index = read_name_array[-1]
-    signatures_set.add(
-        flowcell + ':' + lane_number + ':' +
-        read_number + ':' + barcode_index + ':')
-    signatures_no_barcode_set.add(
-        flowcell + ':' + lane_number + ':' +
-        read_number + ':')
+    signature, signature_no_barcode = get_signatures(
+        flowcell, lane_number, read_number, barcode_index)
+    signatures_set.add(signature)
+    signatures_no_barcode_set.add(signature_no_barcode)
 
 
 def process_new_illumina_prefix(read_name,
@@ -384,23 +486,22 @@ def process_new_illumina_prefix(read_name,
                                 read_numbers_set,
                                 srr_flag):
     if srr_flag:
-        read_number = list(read_numbers_set)[0]
+        read_number = next(iter(read_numbers_set))
     else:
         read_number = '1'
         read_numbers_set.add(read_number)
-    read_name_array = re.split(r':', read_name)
+    read_name_array = read_name.split(':')
 
     if len(read_name_array) > 3:
         flowcell = read_name_array[2]
         lane_number = read_name_array[3]
 
-        prefix = flowcell + ':' + lane_number
+        prefix = f'{flowcell}:{lane_number}'
         if prefix != old_illumina_current_prefix:
             old_illumina_current_prefix = prefix
 
             signatures_set.add(
-                flowcell + ':' + lane_number + ':' +
-                read_number + '::' + read_name)
+                f'{flowcell}:{lane_number}:{read_number}::{read_name}')
 
     return old_illumina_current_prefix
 
@@ -410,7 +511,7 @@ def process_pacbio_read_name_pattern(
         signatures_set,
         movie_identifier
         ):
-    arr = re.split(r'/', read_name)
+    arr = read_name.split('/')
     if len(arr) > 1:
         movie_identifier = arr[0]
         signatures_set.add(
@@ -424,15 +525,15 @@ def process_old_illumina_read_name_pattern(read_name,
                                            old_illumina_current_prefix,
                                            srr_flag):
     if srr_flag:
-        read_number = list(read_numbers_set)[0]
+        read_number = next(iter(read_numbers_set))
     else:
         read_number = '1'
         if read_name[-2:] in ['/1', '/2']:
             read_numbers_set.add(read_name[-1])
             read_number = read_name[-1]
-    arr = re.split(r':', read_name)
+    arr = read_name.split(':')
     if len(arr) > 1:
-        prefix = arr[0] + ':' + arr[1]
+        prefix = f'{arr[0]}:{arr[1]}'
         if prefix != old_illumina_current_prefix:
             old_illumina_current_prefix = prefix
             flowcell = arr[0][1:]
@@ -448,8 +549,7 @@ def process_old_illumina_read_name_pattern(read_name,
             if arr[1].isdigit():
                 lane_number = arr[1]
             signatures_set.add(
-                flowcell + ':' + lane_number + ':' +
-                read_number + '::' + read_name)
+                f'{flowcell}:{lane_number}:{read_number}::{read_name}')
 
     return old_illumina_current_prefix
 
@@ -464,7 +564,7 @@ def process_read_name_line(read_name_line,
     read_name = read_name_line.strip()
     if read_name_details:
         #extract fastq signature parts using read_name_detail
-        read_name_array = re.split(r'[:\s]', read_name)
+        read_name_array = read_name.translate(read_name_delimiters).split(':')
 
         flowcell = read_name_array[read_name_details['flowcell_id_location']]
         lane_number = read_name_array[read_name_details['lane_id_location']]
@@ -479,23 +579,21 @@ def process_read_name_line(read_name_line,
         else:
             barcode_index = read_name_array[read_name_details['barcode_location']]
         
-        signatures_set.add(
-            flowcell + ':' + lane_number + ':' +
-            read_number + ':' + barcode_index + ':')
-        signatures_no_barcode_set.add(
-            flowcell + ':' + lane_number + ':' +
-            read_number + ':')
+        signature, signature_no_barcode = get_signatures(
+            flowcell, lane_number, read_number, barcode_index)
+        signatures_set.add(signature)
+        signatures_no_barcode_set.add(signature_no_barcode)
     else:
-        words_array = re.split(r'\s', read_name)
-        if read_name_pattern.match(read_name) is None:
-            if special_read_name_pattern.match(read_name) is not None:
+        words_array = read_name.translate(read_name_whitespace).split(' ')
+        if match_read_name(read_name) is None:
+            if match_special_read_name(read_name) is not None:
                 process_special_read_name_pattern(read_name,
                                                 words_array,
                                                 signatures_set,
                                                 signatures_no_barcode_set,
                                                 read_numbers_set,
                                                 srr_flag)
-            elif srr_read_name_pattern.match(read_name.split(' ')[0]) is not None:
+            elif match_srr_read_name(read_name.split(' ')[0]) is not None:
                 # in case the readname is following SRR format, read number will be
                 # defined using SRR format specifications, and not by the illumina portion of the read name
                 # srr_flag is used to distinguish between srr and "regular" readname formats
@@ -512,7 +610,7 @@ def process_read_name_line(read_name_line,
                                                                     signatures_set,
                                                                     read_lengths_dictionary,
                                                                     errors, True, read_name_details)
-            elif pacbio_read_name_pattern.match(read_name):
+            elif match_pacbio_read_name(read_name):
                 # pacbio reads include: 
                 # movie identifier that includes the time of run start (m140415_143853)
                 # instrment serial number (42175)
@@ -538,7 +636,7 @@ def process_read_name_line(read_name_line,
                 # current convention is to include WHOLE
                 # readname at the end of the signature
                 if len(words_array) == 1:
-                    if read_name_prefix.match(read_name) is not None:
+                    if match_read_name_prefix(read_name) is not None:
                         # new illumina without second part
                         old_illumina_current_prefix = process_new_illumina_prefix(
                             read_name,
@@ -573,11 +671,25 @@ def process_read_name_line(read_name_line,
     return old_illumina_current_prefix
 
 
-def process_sequence_line(sequence_line, read_lengths_dictionary):
-    length = len(sequence_line.strip())
-    if length not in read_lengths_dictionary:
-        read_lengths_dictionary[length] = 0
-    read_lengths_dictionary[length] += 1
+def process_sequence_lines(sequence_lines, read_lengths_dictionary):
+    # sequence lines are ASCII, their length is the same undecoded
+    read_lengths_dictionary.update(map(len, map(bytes.strip, sequence_lines)))
+
+
+def read_line_chunks(stream, size=FASTQ_READ_SIZE):
+    """ Yield lists of the newline-stripped lines of a binary stream,
+    reading it in chunks of up to size bytes
+    """
+    remainder = b''
+    while True:
+        chunk = stream.read1(size)
+        if not chunk:
+            break
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+        yield lines
+    if remainder:
+        yield [remainder]
 
 
 def process_fastq_file(job, fastq_data_stream, session, url):
@@ -591,38 +703,47 @@ def process_fastq_file(job, fastq_data_stream, session, url):
     read_numbers_set = set()
     signatures_set = set()
     signatures_no_barcode_set = set()
-    read_lengths_dictionary = {}
+    read_lengths_dictionary = collections.Counter()
     read_count = 0
     old_illumina_current_prefix = 'empty'
+    # Ultima FASTQs should be excluded from read name parsing
+    check_read_names = platform_uuid != ULTIMA_PLATFORM
     try:
-        line_index = 0
-        for encoded_line in fastq_data_stream.stdout:
-            try:
-                line = encoded_line.decode('utf-8')
-            except UnicodeDecodeError:
-                errors['readname_encoding'] = 'Error occured, while decoding the readname string.'
-            else:
-                line_index += 1
-                if line_index == 1:
-                    
-                    # may be from here deliver a flag about the presence/absence of the readnamedetails
-
-                    if platform_uuid not in ['25acccbd-cb36-463b-ac96-adbac11227e6']:
-                        old_illumina_current_prefix = \
-                            process_read_name_line(
-                                line,
-                                old_illumina_current_prefix,
-                                read_numbers_set,
-                                signatures_no_barcode_set,
-                                signatures_set,
-                                read_lengths_dictionary,
-                                errors, False,
-                                read_name_details)
-                if line_index == 2:
-                    read_count += 1
-                    process_sequence_line(line, read_lengths_dictionary)
-
-                line_index = line_index % 4
+        # number of lines already read, modulo the 4 lines of a FASTQ record
+        phase = 0
+        for encoded_lines in read_line_chunks(fastq_data_stream.stdout):
+            read_name_lines = encoded_lines[(4 - phase) % 4::4]
+            sequence_lines = encoded_lines[(5 - phase) % 4::4]
+            phase = (phase + len(encoded_lines)) % 4
+
+            read_count += len(sequence_lines)
+            process_sequence_lines(sequence_lines, read_lengths_dictionary)
+
+            # a short read can hold no read name line at all, and joining an
+            # empty list would make up an empty read name
+            if check_read_names and read_name_lines:
+                # decode the whole chunk's read names at once, falling back
+                # to line by line only to skip the ones that are not utf-8
+                try:
+                    read_names = b'\n'.join(read_name_lines).decode('utf-8').split('\n')
+                except UnicodeDecodeError:
+                    read_names = []
+                    for encoded_line in read_name_lines:
+                        try:
+                            read_names.append(encoded_line.decode('utf-8'))
+                        except UnicodeDecodeError:
+                            errors['readname_encoding'] = 'Error occured, while decoding the readname string.'
+                for line in read_names:
+                    old_illumina_current_prefix = \
+                        process_read_name_line(
+                            line,
+                            old_illumina_current_prefix,
+                            read_numbers_set,
+                            signatures_no_barcode_set,
+                            signatures_set,
+                            read_lengths_dictionary,
+                            errors, False,
+                            read_name_details)
     except IOError:
         errors['unzipped_fastq_streaming'] = 'Error occured, while streaming unzipped fastq.'
     else:
@@ -632,7 +753,7 @@ def process_fastq_file(job, fastq_data_stream, session, url):
 
         # read1/read2
         # Ultima FASTQs should be excluded from read pairing checks
-        if platform_uuid not in ['25acccbd-cb36-463b-ac96-adbac11227e6']:
+        if platform_uuid != ULTIMA_PLATFORM:
             if len(read_numbers_set) > 1:
                 errors['inconsistent_read_numbers'] = \
                     'fastq file contains mixed read numbers ' + \
@@ -641,20 +762,9 @@ def process_fastq_file(job, fastq_data_stream, session, url):
                                      'Fastq file contains a mixture of read1 and read2 sequences')
 
         # read_length
-        read_lengths_list = []
-        for k in sorted(read_lengths_dictionary.keys()):
-            read_lengths_list.append((k, read_lengths_dictionary[k]))
-
         #excluding Pacbio, Nanopore, and Ultima from read_length verification
-        if platform_uuid not in ['ced61406-dcc6-43c4-bddd-4c977cc676e8',
-                                 'c7564b38-ab4f-4c42-a401-3de48689a998',
-                                 'e2be5728-5744-4da4-8881-cb9526d0389e',
-                                 '7cc06b8c-5535-4a77-b719-4c23644e767d',
-                                 '8f1a9a8c-3392-4032-92a8-5d196c9d7810',
-                                 '6c275b37-018d-4bf8-85f6-6e3b830524a9',
-                                 '6ce511d5-eeb3-41fc-bea7-8c38301e88c1',
-                                 '25acccbd-cb36-463b-ac96-adbac11227e6'
-                                 ]:
+        if platform_uuid not in LONG_READ_PLATFORMS:
+            read_lengths_list = sorted(read_lengths_dictionary.items())
             if 'read_length' in item and item['read_length'] > 2:
                 process_read_lengths(read_lengths_dictionary,
                                      read_lengths_list,
@@ -673,7 +783,7 @@ def process_fastq_file(job, fastq_data_stream, session, url):
                                          ', '.join(map(str, read_lengths_list))))
         # signatures
         # Ultima FASTQs should be excluded from signature checks
-        if platform_uuid in ['25acccbd-cb36-463b-ac96-adbac11227e6']:
+        if platform_uuid == ULTIMA_PLATFORM:
             return
         signatures_for_comparison = set()
         is_UMI = False
@@ -706,25 +816,16 @@ def process_fastq_file(job, fastq_data_stream, session, url):
 
 def process_barcodes(signatures_set):
     set_to_return = set()
-    flowcells_dict = {}
+    flowcells_dict = collections.defaultdict(collections.Counter)
     for entry in signatures_set:
         (f, l, r, b, rest) = entry.split(':')
-        if (f, l, r) not in flowcells_dict:
-            flowcells_dict[(f, l, r)] = {}
-        if b not in flowcells_dict[(f, l, r)]:
-            flowcells_dict[(f, l, r)][b] = 0
         flowcells_dict[(f, l, r)][b] += 1
-    for key in flowcells_dict.keys():
-        barcodes_dict = flowcells_dict[key]
-        total = 0
-        for b in barcodes_dict.keys():
-            total += barcodes_dict[b]
-        for b in barcodes_dict.keys():
-            if ((float(total)/float(barcodes_dict[b])) < 100):
-                set_to_return.add(key[0] + ':' +
-                                  key[1] + ':' +
-                                  key[2] + ':' +
-                                  b + ':')
+    for (f, l, r), barcodes_dict in flowcells_dict.items():
+        total = sum(barcodes_dict.values())
+        for b, count in barcodes_dict.items():
+            # total / count < 100, without the float division
+            if total < 100 * count:
+                set_to_return.add(f'{f}:{l}:{r}:{b}:')
     return set_to_return
 
 
@@ -735,63 +836,63 @@ def process_read_lengths(read_lengths_dict,
                          threshold_percentage,
                          errors_to_report,
                          result):
-    reads_quantity = sum([count for length, count in read_lengths_dict.items()
-                          if (submitted_read_length - 2) <= length <= (submitted_read_length + 2)])
-    informative_length_list = []
-    for readLength in lengths_list:
-        informative_length_list.append('bp, '.join(map(str,readLength)))
+    # the window is five lengths wide, look them up rather than scanning every length
+    reads_quantity = sum(read_lengths_dict.get(length, 0)
+                         for length in range(submitted_read_length - 2, submitted_read_length + 3))
     if ((threshold_percentage * read_count) > reads_quantity):
+        # only needed for the error message
+        informative_lengths = ', '.join(
+            '({}bp, {})'.format(length, count) for length, count in lengths_list)
         errors_to_report['read_length'] = \
             'in file metadata the read_length is {}bp, '.format(submitted_read_length) + \
             'however the uploaded fastq file contains reads of following length(s) ' + \
-            '{}. '.format(', '.join(map(str, ['(%s)' % item for item in informative_length_list])))
+            '{}. '.format(informative_lengths)
         update_content_error(errors_to_report,
                              'Fastq file metadata specified read length was {}bp, '.format(
                                  submitted_read_length) +
                              'but the file contains read length(s) {}'.format(
-                                ', '.join(map(str, ['(%s)' %item for item in informative_length_list]))))
+                                informative_lengths))
 
 
 def create_a_list_of_barcodes(details):
-    barcodes = set()
-    for entry in details:
-        barcode = entry.get('barcode')
-        lane = entry.get('lane')
-        if lane and barcode:
-            barcodes.add((lane, barcode))
-    return barcodes
+    return frozenset((entry.get('lane'), entry.get('barcode')) for entry in details
+                     if entry.get('lane') and entry.get('barcode'))
 
 
 def compare_flowcell_details(flowcell_details_1, flowcell_details_2):
-    barcodes_1 = create_a_list_of_barcodes(flowcell_details_1)
-    barcodes_2 = create_a_list_of_barcodes(flowcell_details_1)
-    if barcodes_1 & barcodes_2:
-        # intersection found
-        return True
-    # no intersection
-    return False
+    # True when the two share a (lane, barcode) pair
+    return not create_a_list_of_barcodes(flowcell_details_1).isdisjoint(
+        create_a_list_of_barcodes(flowcell_details_2))
 
 
-def get_mapped_run_type_bam(job, bam_data_stream):
+def get_mapped_properties_bam(job, bam_data_stream):
     """ 
-    obtain mapped run type from all bams by using samtools stats
+    obtain mapped run type and mapped read length from all bams by using a
+    single samtools stats run
     """
     errors = job['errors']
     result = job['result']
     numPairedReads = None
-    for line in bam_data_stream.stdout.readlines():
+    readLengthLine = None
+    for line in bam_data_stream.stdout:
         line = line.strip()
-        try:
-            assert('Failure' not in line)
-        except AssertionError:
+        if 'Failure' in line:
             errors['samtools_stats_decoding_failure'] = line
             update_content_error(errors, 'File failed samtools stats extraction. ' +
                                             errors['samtools_stats_decoding_failure'])
-        else:
-            if 'SN' in line and 'reads paired' in line.strip():
-                line = line.split('\t')
-                numPairedReads = line[2]
-                result['samtools_stats_mapped_run_type_extraction'] = line
+        elif line.startswith('RL\t'):
+            # most frequent read length, as in the samtools documentation's
+            # grep ^RL | cut -f 2- | sort -k2 -n -r | head -1
+            # http://www.htslib.org/doc/samtools-stats.html
+            line = line[len('RL\t'):]
+            if readLengthLine is None or \
+               (int(line.split('\t')[1]), line) > (int(readLengthLine.split('\t')[1]), readLengthLine):
+                readLengthLine = line
+        elif 'SN' in line and 'reads paired' in line:
+            line = line.split('\t')
+            numPairedReads = line[2]
+            result['samtools_stats_mapped_run_type_extraction'] = line
+
     runType = None
     if numPairedReads:
         if int(numPairedReads) > 0:
@@ -799,62 +900,92 @@ def get_mapped_run_type_bam(job, bam_data_stream):
         else:
             runType = 'single-ended'
 
-    return runType
+    readLength = None
+    if readLengthLine is not None:
+        line = readLengthLine.split('\t')
+        readLength = int(line[0])
+        result['samtools_stats_mapped_read_length_extraction'] = line
 
+    return runType, readLength
 
-def  get_mapped_read_length_bam(job, bam_data_stream):
-    """ 
-    obtain mapped read length from all bams by using samtools stats
+
+# frame=object views by (url, @id). The session is left out of the key since
+# every pool task gets its own unpickled copy of it.
+portal_objects = {}
+# the platform lookups share the cache between threads, so the size check,
+# clear and store happen under the lock
+portal_objects_lock = threading.Lock()
+
+
+def cache_portal_objects(objects):
+    with portal_objects_lock:
+        if len(portal_objects) >= PORTAL_OBJECTS_CACHE_SIZE:
+            portal_objects.clear()
+        portal_objects.update(objects)
+
+
+def get_object(item_id, session, url):
+    """ frame=object view of a portal item, cached since the same files and
+    platforms are looked up over and over across jobs
     """
-    errors = job['errors']
-    result = job['result']
-    readLength = None
-    for line in bam_data_stream.stdout.readlines():
-        line = line.strip()
-        try:
-            assert('Failure' not in line)
-        except AssertionError:
-            errors['samtools_stats_decoding_failure'] = line
-            update_content_error(errors, 'File failed samtools stats extraction. ' +
-                                            errors['samtools_stats_decoding_failure'])
-        else:
-            line = line.split('\t')
-            readLength = int(line[0])
-            result['samtools_stats_mapped_read_length_extraction'] = line  
-    return readLength
+    key = (url, item_id)
+    obj = portal_objects.get(key)
+    if obj is None:
+        query = item_id + '?datastore=database&frame=object&format=json'
+        r = session.get(urljoin(url, query))
+        obj = r.json()
+        # error bodies are handed back as they are, but never cached, so a
+        # transient portal error is not served for the rest of the run
+        if r.ok:
+            cache_portal_objects({key: obj})
+    return obj
+
+
+
+def get_objects(item_ids, session, url):
+    """ frame=object views of several portal files, fetching the ones that are
+    not cached yet with one search per IDS_PER_SEARCH ids
+    """
+    missing = [item_id for item_id in item_ids if (url, item_id) not in portal_objects]
+    for start in range(0, len(missing), IDS_PER_SEARCH):
+        params = [('type', 'File'), ('datastore', 'database'), ('frame', 'object'),
+                  ('format', 'json'), ('limit', 'all')]
+        params.extend(('@id', item_id) for item_id in missing[start:start + IDS_PER_SEARCH])
+        r = session.get(urljoin(url, '/search/?' + urlencode(params)))
+        # the portal answers an empty search with a 404
+        if r.status_code == 404:
+            continue
+        r.raise_for_status()
+        cache_portal_objects({(url, obj['@id']): obj for obj in r.json()['@graph']})
+    # search leaves out some statuses (deleted, replaced), those are fetched one by one
+    return [get_object(item_id, session, url) for item_id in item_ids]
 
 
 def get_read_name_details(job_id, errors, session, url):
-    query = job_id +'?datastore=database&frame=object&format=json'
     try:
-        r = session.get(urljoin(url, query))
+        details = get_object(job_id, session, url).get('read_name_details')
     except requests.exceptions.RequestException as e:
         errors['lookup_for_read_name_detaisl'] = ('Network error occured, while looking for '
                                                   'file read_name details on the portal. {}').format(str(e))
     else:
-        details = r.json().get('read_name_details')
         if details:
             return details
 
 
 def get_platform_uuid(job_id, errors, session, url):
-    query = job_id +'?datastore=database&frame=object&format=json'
     try:
-        r = session.get(urljoin(url, query))
+        platform_id = get_object(job_id, session, url).get('platform')
     except requests.exceptions.RequestException as e:
         errors['lookup_for_platform'] = ('Network error occured, while looking for '
                                          'platform on the portal. {}').format(str(e))
     else:
-        platform_id = r.json().get('platform')
         if platform_id:
-            query = platform_id +'?datastore=database&frame=object&format=json'
             try:
-                r = session.get(urljoin(url, query))
+                platform_uuid = get_object(platform_id, session, url).get('uuid')
             except requests.exceptions.RequestException as e:
                 errors['lookup_for_platform'] = ('Network error occured, while looking for '
                                                 'platform on the portal. {}').format(str(e))
             else:
-                platform_uuid = r.json().get('uuid')
                 return platform_uuid
         return platform_id  
 
@@ -867,92 +998,114 @@ def get_all_derived_from(job_id, errors, session, url):
     while remaining:
         derived_from_list.update(remaining)
         next_remaining = set()
-        for file in remaining: 
-            query = file +'?datastore=database&frame=object&format=json'
-            try:
-                r = session.get(urljoin(url, query))
-            except requests.exceptions.RequestException as e:
-                errors['lookup_for_file_derived_from'] = ('Network error occured, while looking for '
-                                                'derived_from on the portal. {}').format(str(e))
-            else:
-                try:
-                    next_remaining.update(r.json().get('derived_from'))
-                except TypeError:
-                    pass 
+        try:
+            files = get_objects(list(remaining), session, url)
+        except requests.exceptions.RequestException as e:
+            errors['lookup_for_file_derived_from'] = ('Network error occured, while looking for '
+                                            'derived_from on the portal. {}').format(str(e))
+        else:
+            for file in files:
+                next_remaining.update(file.get('derived_from') or ())
         remaining = next_remaining - derived_from_list
     return derived_from_list
 
 
 def get_platform_from_bams(job_id, errors, session, url):
-    query = job_id +'?datastore=database&frame=object&format=json'
     platform_list = []
-    try:
-        r = session.get(urljoin(url, query))
-    except requests.exceptions.RequestException as e:
-        errors['lookup_for_derived_from'] = ('Network error occured, while looking for '
-                                         'derived_from on the portal. {}').format(str(e))
-    else:
-        derived_from_list = get_all_derived_from(r.json().get('@id'), errors, session, url)
-        if derived_from_list:
-            for file in derived_from_list:
-                query = file +'?datastore=database&frame=object&format=json'
-                try:
-                    r = session.get(urljoin(url, query))
-                except requests.exceptions.RequestException as e:
-                    errors['lookup_for_file'] = ('Network error occured, while looking for '
-                                                    'file_format on the portal. {}').format(str(e))
-                else:
-                    file_format = r.json().get('file_format')
-                    if file_format == 'fastq':
-                        platform_uuid = get_platform_uuid(file, errors, session, url)
-                        if platform_uuid:
-                            platform_list.append(platform_uuid)
+    # job_id is already the file's @id, no need to fetch the file for it
+    derived_from_list = get_all_derived_from(job_id, errors, session, url)
+    if derived_from_list:
+        try:
+            files = get_objects(list(derived_from_list), session, url)
+        except requests.exceptions.RequestException as e:
+            errors['lookup_for_file'] = ('Network error occured, while looking for '
+                                            'file_format on the portal. {}').format(str(e))
+        else:
+            fastqs = [file['@id'] for file in files if file.get('file_format') == 'fastq']
+            if fastqs:
+                # the fastq objects are cached by now, what is left are the platform lookups
+                with ThreadPoolExecutor(max_workers=min(len(fastqs), PLATFORM_LOOKUP_THREADS)) as executor:
+                    platform_uuids = executor.map(
+                        lambda fastq: get_platform_uuid(fastq, errors, session, url), fastqs)
+                platform_list.extend(
+                    platform_uuid for platform_uuid in platform_uuids if platform_uuid)
     return set(platform_list)
 
 
+def signature_batches(signatures):
+    """ signatures in batches whose fastq_signature= parameters stay within
+    SIGNATURE_SEARCH_LENGTH once urlencoded, one signature per batch at least
+    """
+    batch = []
+    length = 0
+    for signature in signatures:
+        signature_length = len(urlencode([('fastq_signature', signature)])) + 1
+        if batch and length + signature_length > SIGNATURE_SEARCH_LENGTH:
+            yield batch
+            batch = []
+            length = 0
+        batch.append(signature)
+        length += signature_length
+    if batch:
+        yield batch
+
+
 def check_for_fastq_signature_conflicts(session,
                                         url,
                                         errors,
                                         item,
                                         signatures_to_check):
+    signatures = sorted(signature for signature in signatures_to_check
+                        if not signature.endswith('mixed:'))
+    # files on the portal by each of their signatures, looked up with as few
+    # searches as the URL length allows
+    files_by_signature = collections.defaultdict(list)
+    for batch in signature_batches(signatures):
+        params = [('type', 'File'), ('status!', 'replaced'), ('file_format', 'fastq'),
+                  ('datastore', 'database'), ('limit', 'all'), ('field', 'accession'),
+                  ('field', 'flowcell_details'), ('field', 'fastq_signature')]
+        params.extend(('fastq_signature', signature) for signature in batch)
+        try:
+            r = session.get(urljoin(url, '/search/?' + urlencode(params)))
+            # a 404 means no file has these signatures, the usual case
+            if r.status_code == 404:
+                continue
+            r.raise_for_status()
+            r_graph = r.json().get('@graph')
+        except (requests.exceptions.RequestException, ValueError) as e:
+            errors['lookup_for_fastq_signature'] = 'Network error occured, while looking for ' + \
+                                                   'fastq signature conflict on the portal. ' + \
+                                                   str(e)
+        else:
+            batch = set(batch)
+            for entry in r_graph:
+                for signature in batch.intersection(entry.get('fastq_signature', ())):
+                    files_by_signature[signature].append(entry)
+
     conflicts = []
-    for signature in sorted(list(signatures_to_check)):
-        if not signature.endswith('mixed:'):
-            query = '/search/?type=File&status!=replaced&file_format=fastq&' + \
-                    'datastore=database&fastq_signature=' + signature
-            try:
-                r = session.get(urljoin(url, query))
-            except requests.exceptions.RequestException as e:
-                errors['lookup_for_fastq_signature'] = 'Network error occured, while looking for ' + \
-                                                       'fastq signature conflict on the portal. ' + \
-                                                       str(e)
+    for signature in signatures:
+        # found a conflict
+        for entry in files_by_signature.get(signature, ()):
+            # the file itself, or a file that cannot be told apart from it
+            if 'accession' in item and entry.get('accession', item['accession']) == item['accession']:
+                continue
+            #  the conflict in case of missing barcode in read names could be resolved with metadata flowcell details
+            if signature.endswith('::') and not (
+                    entry.get('flowcell_details') and
+                    item.get('flowcell_details') and
+                    compare_flowcell_details(entry.get('flowcell_details'),
+                                             item.get('flowcell_details'))):
+                continue
+            if 'accession' in entry:
+                conflicts.append(
+                    '%s in file %s ' % (
+                        signature,
+                        entry['accession']))
             else:
-                r_graph = r.json().get('@graph')
-                # found a conflict
-                if len(r_graph) > 0:
-                    #  the conflict in case of missing barcode in read names could be resolved with metadata flowcell details
-                    for entry in r_graph:
-                        if (not signature.endswith('::') or
-                            (signature.endswith('::') and entry.get('flowcell_details') and
-                             item.get('flowcell_details') and
-                             compare_flowcell_details(entry.get('flowcell_details'),
-                                                      item.get('flowcell_details')))):
-                                if 'accession' in entry and 'accession' in item and \
-                                   entry['accession'] != item['accession']:
-                                        conflicts.append(
-                                            '%s in file %s ' % (
-                                                signature,
-                                                entry['accession']))
-                                elif 'accession' in entry and 'accession' not in item:
-                                    conflicts.append(
-                                        '%s in file %s ' % (
-                                            signature,
-                                            entry['accession']))
-                                elif 'accession' not in entry and 'accession' not in item:
-                                    conflicts.append(
-                                        '%s ' % (
-                                            signature) +
-                                        'file on the portal.')
+                conflicts.append(
+                    '%s ' % (
+                        signature) +
+                    'file on the portal.')
 
     # "Fastq file contains read name signatures that conflict with signatures from file X”]
     if len(conflicts) > 0:
@@ -970,14 +1123,12 @@ def check_for_fastq_signature_conflicts(session,
 
 def check_for_contentmd5sum_conflicts(item, result, output, errors, session, url):
     result['content_md5sum'] = output[:32].decode(errors='replace')
-    try:
-        int(result['content_md5sum'], 16)
-    except ValueError:
+    if not match_md5sum(result['content_md5sum']):
         errors['content_md5sum'] = output.decode(errors='replace').rstrip('\n')
         update_content_error(errors, 'File content md5sum format error')
     else:
-        query = '/search/?type=File&status!=replaced&datastore=database&content_md5sum=' + result[
-            'content_md5sum']
+        query = '/search/?type=File&status!=replaced&datastore=database&field=accession&' + \
+                'content_md5sum=' + result['content_md5sum']
         try:
             r = session.get(urljoin(url, query))
         except requests.exceptions.RequestException as e:
@@ -985,7 +1136,8 @@ def check_for_contentmd5sum_conflicts(item, result, output, errors, session, url
                                                   'content md5sum conflict on the portal. ' + str(e)
         else:
             try:
-                r_graph = r.json().get('@graph')
+                # a 404 means no file has this content md5sum, the usual case
+                r_graph = r.json().get('@graph') if r.status_code != 404 else []
             except ValueError:
                 errors['content_md5sum_lookup_json_error'] = str(r)
             else:
@@ -1015,6 +1167,92 @@ def check_for_contentmd5sum_conflicts(item, result, output, errors, session, url
                                                  ', '.join(map(str, conflicts))))
 
 
+def read_file_chunks(path, size=MD5_READ_SIZE):
+    """ Yield the content of the file at path as views of a single reused
+    buffer, with the kernel told to expect a sequential read
+    """
+    with open(path, 'rb', buffering=0) as f:
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except (AttributeError, OSError):
+            pass
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        while True:
+            length = f.readinto(buffer)
+            if not length:
+                break
+            yield view[:length]
+
+
+def md5sum_file(path, content=False):
+    """ md5sum of the file at path. With content set, the file is also fed to
+    `gunzip | md5sum` as it is read, so the content md5sum costs no second
+    read of the file. Returns (md5sum, content md5sum output, content error),
+    the last two are None when not computed.
+    """
+    md5 = hashlib.md5()
+    if not content:
+        for chunk in read_file_chunks(path):
+            md5.update(chunk)
+        return md5.hexdigest(), None, None
+
+    # gunzip's stderr goes to a file: as a pipe nobody reads while the
+    # chunks are written, enough warnings would fill it and block gunzip,
+    # and with it this loop
+    gunzip_stderr = tempfile.TemporaryFile()
+    gunzip = subprocess.Popen(['gunzip', '--stdout'], stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE, stderr=gunzip_stderr)
+    content_md5sum = subprocess.Popen(['md5sum'], stdin=gunzip.stdout, stdout=subprocess.PIPE)
+    gunzip.stdout.close()
+    gunzip_running = True
+    try:
+        for chunk in read_file_chunks(path):
+            md5.update(chunk)
+            if gunzip_running:
+                try:
+                    gunzip.stdin.write(chunk)
+                except BrokenPipeError:
+                    # gunzip gave up on the file, keep reading for the md5sum
+                    gunzip_running = False
+    finally:
+        try:
+            gunzip.stdin.close()
+        except BrokenPipeError:
+            pass
+        gunzip.wait()
+        content_output = content_md5sum.communicate()[0]
+        gunzip_stderr.seek(0)
+        gunzip_error = gunzip_stderr.read()
+        gunzip_stderr.close()
+    if gunzip.returncode:
+        return md5.hexdigest(), None, gunzip_error.decode(errors='replace').strip()
+    return md5.hexdigest(), content_output, None
+
+
+def remove_bed_comments(path, modified_path):
+    """ Write the gzipped bed at path, without its '#' comment lines, to
+    modified_path in a single decompression pass. The modified bed is only
+    written when there are comments; returns whether there were.
+    """
+    modified = None
+    try:
+        with gzip.open(path, 'rb') as bed:
+            for number, line in enumerate(bed):
+                if line.startswith(b'#'):
+                    if modified is None:
+                        modified = open(modified_path, 'wb')
+                        # comments are usually a header, but copy any lines before them
+                        with gzip.open(path, 'rb') as head:
+                            modified.writelines(islice(head, number))
+                elif modified is not None:
+                    modified.write(line)
+    finally:
+        if modified is not None:
+            modified.close()
+    return modified is not None
+
+
 def check_file(config, session, url, job):
     item = job['item']
     errors = job['errors']
@@ -1061,27 +1299,26 @@ def check_file(config, session, url, job):
         result["last_modified"] = datetime.datetime.utcfromtimestamp(
             file_stat.st_mtime).isoformat() + 'Z'
 
-        # Faster than doing it in Python.
         try:
-            output = subprocess.check_output(
-                ['md5sum', local_path], stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            errors['md5sum'] = e.output.decode(errors='replace').rstrip('\n')
+            is_gzipped = is_path_gzipped(local_path)
+        except Exception as e:
+            is_gzipped = None
+        # the gunzipped content is md5summed off the same read of the file
+        content_output = content_error = None
+        try:
+            md5sum, content_output, content_error = md5sum_file(
+                local_path, bool(is_gzipped) and item['file_format'] in GZIP_TYPES)
+        except OSError as e:
+            errors['md5sum'] = str(e)
         else:
-            result['md5sum'] = output[:32].decode(errors='replace')
-            try:
-                int(result['md5sum'], 16)
-            except ValueError:
-                errors['md5sum'] = output.decode(errors='replace').rstrip('\n')
+            result['md5sum'] = md5sum
             if result['md5sum'] != item['md5sum']:
                 errors['md5sum'] = \
                     'checked %s does not match item %s' % (result['md5sum'], item['md5sum'])
                 update_content_error(errors,
                                      'File metadata-specified md5sum {} '.format(item['md5sum']) +
                                      'does not match the calculated md5sum {}'.format(result['md5sum']))
-        try:
-            is_gzipped = is_path_gzipped(local_path)
-        except Exception as e:
+        if is_gzipped is None:
             return job
         else:
             if item['file_format'] not in GZIP_TYPES:
@@ -1092,46 +1329,21 @@ def check_file(config, session, url, job):
                 errors['gzip'] = 'Expected gzipped file'
                 update_content_error(errors, 'Expected gzipped file')
             else:
-                # May want to replace this with something like:
-                # $ cat $local_path | tee >(md5sum >&2) | gunzip | md5sum
-                # or http://stackoverflow.com/a/15343686/199100
-                try:
-                    output = subprocess.check_output(
-                        'set -o pipefail; gunzip --stdout %s | md5sum' % quote(local_path),
-                        shell=True, executable='/bin/bash', stderr=subprocess.STDOUT)
-                except subprocess.CalledProcessError as e:
-                    errors['content_md5sum'] = e.output.decode(errors='replace').rstrip('\n')
-                else:
-                    check_for_contentmd5sum_conflicts(item, result, output, errors, session, url)
+                if content_error is not None:
+                    errors['content_md5sum'] = content_error
+                elif content_output is not None:
+                    check_for_contentmd5sum_conflicts(item, result, content_output, errors, session, url)
 
                 if item['file_format'] == 'bed':
-                    # try to count comment lines
-                    try:
-                        output = subprocess.check_output(
-                            'set -o pipefail; gunzip --stdout {} | grep -c \'^#\''.format(local_path),
-                            shell=True, executable='/bin/bash', stderr=subprocess.STDOUT)
-                    except subprocess.CalledProcessError as e:
-                        # empty file, or other type of error
-                        if e.returncode > 1:
-                            errors['grep_bed_problem'] = e.output.decode(errors='replace').rstrip('\n')
-                    # comments lines found, need to calculate content md5sum as usual
+                    # comment lines found, need to calculate content md5sum as usual
                     # remove the comments and create modified.bed to give validateFiles scritp
                     # not forget to remove the modified.bed after finishing
-                    else:
-                        try:
-                            is_local_bed_present = True
-                            subprocess.check_output(
-                                'set -o pipefail; gunzip --stdout {} | grep -v \'^#\' > {}'.format(
-                                    local_path,
-                                    unzipped_modified_bed_path),
-                                shell=True, executable='/bin/bash', stderr=subprocess.STDOUT)
-                        except subprocess.CalledProcessError as e:
-                            # empty file
-                            if e.returncode > 1:
-                                errors['grep_bed_problem'] = e.output.decode(errors='replace').rstrip('\n')
-                            else:
-                                errors['bed_comments_remove_failure'] = e.output.decode(
-                                    errors='replace').rstrip('\n')
+                    try:
+                        is_local_bed_present = remove_bed_comments(
+                            local_path, unzipped_modified_bed_path)
+                    except (OSError, EOFError, zlib.error) as e:
+                        errors['grep_bed_problem'] = str(e)
+                        remove_local_file(unzipped_modified_bed_path, errors)
 
             if is_local_bed_present:
                 check_format(config['encValData'], job, unzipped_modified_bed_path)
@@ -1141,13 +1353,10 @@ def check_file(config, session, url, job):
 
             if item['file_format'] == 'fastq' and not errors.get('validateFiles'):
                 try:
-                    process_fastq_file(job,
-                                    subprocess.Popen(['gunzip --stdout {}'.format(
-                                                        local_path)],
-                                                        shell=True,
-                                                        executable='/bin/bash',
-                                                        stdout=subprocess.PIPE),
-                                    session, url)
+                    with subprocess.Popen(['gunzip', '--stdout', local_path],
+                                          stdout=subprocess.PIPE,
+                                          bufsize=FASTQ_READ_SIZE) as gunzip:
+                        process_fastq_file(job, gunzip, session, url)
                 except subprocess.CalledProcessError as e:
                     errors['fastq_information_extraction'] = 'Failed to extract information from ' + \
                                                             local_path
@@ -1160,37 +1369,15 @@ def check_file(config, session, url, job):
             if item['file_format'] == 'bam' and not errors.get('validateFiles') and 'subreads' not in item['output_type']:
                 platform_list = get_platform_from_bams(job.get('@id'), errors, session, url)
                 if platform_list:
-                    not_Nanopore_PacBio_Ultima = True
-                    for platform in platform_list:
-                        if platform in ['ced61406-dcc6-43c4-bddd-4c977cc676e8',
-                                        'c7564b38-ab4f-4c42-a401-3de48689a998',
-                                        'e2be5728-5744-4da4-8881-cb9526d0389e',
-                                        '7cc06b8c-5535-4a77-b719-4c23644e767d',
-                                        '8f1a9a8c-3392-4032-92a8-5d196c9d7810',
-                                        '6c275b37-018d-4bf8-85f6-6e3b830524a9',
-                                        '6ce511d5-eeb3-41fc-bea7-8c38301e88c1',
-                                        '25acccbd-cb36-463b-ac96-adbac11227e6'
-                                        ]:
-                            not_Nanopore_PacBio_Ultima = False
-                            break
-                    if not_Nanopore_PacBio_Ultima:
+                    if platform_list.isdisjoint(LONG_READ_PLATFORMS):
                         runType = None
                         readLength = None
                         try:
-                            runType = get_mapped_run_type_bam(job,subprocess.Popen(
-                                ['samtools', 'stats', local_path], 
-                                                            stdout=subprocess.PIPE,
-                                                            stderr=subprocess.PIPE, 
-                                                            universal_newlines=True))
-                            # command from samtools documentation: http://www.htslib.org/doc/samtools-stats.html 
-                            readLength = get_mapped_read_length_bam(job,subprocess.Popen(
-                                ['samtools stats {} | grep ^RL | cut -f 2- | sort -k2 -n -r | head -1'.format(
-                                                            local_path)], 
-                                                            stdout=subprocess.PIPE,
-                                                            stderr=subprocess.PIPE,
-                                                            shell=True,
-                                                            executable='/bin/bash',
-                                                            universal_newlines=True))
+                            with subprocess.Popen(['samtools', 'stats', local_path],
+                                                  stdout=subprocess.PIPE,
+                                                  stderr=subprocess.DEVNULL,
+                                                  universal_newlines=True) as samtools_stats:
+                                runType, readLength = get_mapped_properties_bam(job, samtools_stats)
                         except subprocess.CalledProcessError as e:
                             errors['samtools_stats_extraction'] = 'Failed to extract information from ' + \
                                                                     local_path
@@ -1219,15 +1406,13 @@ def check_file(config, session, url, job):
 
 def remove_local_file(path_to_the_file, errors):
     try:
-        path_to_the_file = path_to_the_file
-        if os.path.exists(path_to_the_file):
-            try:
-                os.remove(path_to_the_file)
-            except OSError:
-                errors['file_remove_error'] = 'OS could not remove the file ' + \
-                                              path_to_the_file
-    except NameError:
+        os.remove(path_to_the_file)
+    except FileNotFoundError:
         pass
+    except OSError:
+        errors['file_remove_error'] = 'OS could not remove the file ' + \
+                                      path_to_the_file
+
 
 def extract_accession(file_path):
     return file_path.split('/')[-1].split('.')[0]
@@ -1236,91 +1421,100 @@ def fetch_files(session, url, search_query, out, include_unexpired_upload=False,
     graph = []
     # checkfiles using a file with a list of file accessions to be checked
     if file_list:
-        r = None
         ACCESSIONS = []
         if os.path.isfile(file_list):
-            ACCESSIONS = [line.rstrip('\n') for line in open(file_list)]
-        for acc in ACCESSIONS:
-            r = session.get(
-                urljoin(url, '/search/?field=@id&limit=all&type=File&accession=' + acc))
+            with open(file_list) as accessions_file:
+                # blank lines (a trailing newline, spacing between groups)
+                # would otherwise be sent as empty accession= params
+                ACCESSIONS = [acc for acc in (line.strip() for line in accessions_file) if acc]
+        # one search per IDS_PER_SEARCH accessions
+        for start in range(0, len(ACCESSIONS), IDS_PER_SEARCH):
+            params = [('field', '@id'), ('field', 's3_uri'), ('limit', 'all'), ('type', 'File')]
+            params.extend(('accession', acc) for acc in ACCESSIONS[start:start + IDS_PER_SEARCH])
+            r = session.get(urljoin(url, '/search/?' + urlencode(params)))
             try:
                 r.raise_for_status()
             except requests.HTTPError:
                 return
             else:
-                local = copy.deepcopy(r.json()['@graph'])
-                graph.extend(local)
+                graph.extend(orjson.loads(r.content)['@graph'])
     # checkfiles using a query
     elif local_file:
         r = session.get(
-            urljoin(url, '/search/?field=@id&limit=all&type=File&accession=' + extract_accession(local_file)))
+            urljoin(url, '/search/?field=@id&field=s3_uri&limit=all&type=File&accession=' + extract_accession(local_file)))
         try:
             r.raise_for_status()
         except requests.HTTPError:
             return
         else:
-            graph = r.json()['@graph']
+            graph = orjson.loads(r.content)['@graph']
     else:
         r = session.get(
-            urljoin(url, '/search/?field=@id&limit=all&type=File&' + search_query))
+            urljoin(url, '/search/?field=@id&field=s3_uri&limit=all&type=File&' + search_query))
         try:
             r.raise_for_status()
         except requests.HTTPError:
             return
         else:
-            graph = r.json()['@graph']
-
-    for result in graph:
-        job = {
-            '@id': result['@id'],
-            'errors': {},
-            'run': datetime.datetime.utcnow().isoformat() + 'Z',
-        }
-        errors = job['errors']
-        item_url = urljoin(url, job['@id'])
-        fileObject = session.get(item_url)
-        r = session.get(item_url + '@@upload?datastore=database')
-        if not fileObject.ok:
-            errors['file_HTTPError'] = ('HTTP error: unable to get file object')
-        if fileObject.ok and r.ok:
-            upload_credentials = r.json()['@graph'][0]['upload_credentials']
-            try: 
-                if fileObject.json()['s3_uri']:
-                    job['download_url'] = fileObject.json()['s3_uri']
-            except KeyError:
+            graph = orjson.loads(r.content)['@graph']
+
+    # one timestamp for the whole batch, the upload expirations are compared to it
+    run_timestamp = datetime.datetime.utcnow().isoformat() + 'Z'
+    with ThreadPoolExecutor(max_workers=2) as fetcher:
+        for result in graph:
+            job = {
+                '@id': result['@id'],
+                'errors': {},
+                'run': run_timestamp,
+            }
+            errors = job['errors']
+            item_url = urljoin(url, job['@id'])
+            # s3_uri comes with the search results, only the upload
+            # credentials and the etag need requests of their own, and
+            # those two are sent together
+            r, edit_r = fetcher.map(session.get, [
+                item_url + '@@upload?datastore=database',
+                item_url + '?frame=edit&datastore=database',
+            ])
+            if r.ok:
+                upload_credentials = r.json()['@graph'][0]['upload_credentials']
                 try:
-                    job['download_url'] = upload_credentials['upload_url']
+                    if result['s3_uri']:
+                        job['download_url'] = result['s3_uri']
                 except KeyError:
-                    errors['download_url_missing'] = ('download url is missing')
-            # Files grandfathered from EDW have no upload expiration.
-            job['upload_expiration'] = upload_credentials.get('expiration', '')
-            # Only check files that will not be changed during the check.
-            if job['run'] < job['upload_expiration']:
-                if not include_unexpired_upload:
-                    job['errors']['unexpired_credentials'] = (
-                        'File status have not been changed, the file '
-                        'check was skipped due to file\'s '
-                        'unexpired upload credentials'
-                    )
-        else:
-            job['errors']['get_upload_url_request'] = \
-                '{} {}\n{}'.format(r.status_code, r.reason, r.text)
-        r = session.get(item_url + '?frame=edit&datastore=database')
-        if r.ok:
-            item = job['item'] = r.json()
-            job['etag'] = r.headers['etag']
-        else:
-            errors['get_edit_request'] = \
-                '{} {}\n{}'.format(r.status_code, r.reason, r.text)
+                    try:
+                        job['download_url'] = upload_credentials['upload_url']
+                    except KeyError:
+                        errors['download_url_missing'] = ('download url is missing')
+                # Files grandfathered from EDW have no upload expiration.
+                job['upload_expiration'] = upload_credentials.get('expiration', '')
+                # Only check files that will not be changed during the check.
+                if job['run'] < job['upload_expiration']:
+                    if not include_unexpired_upload:
+                        job['errors']['unexpired_credentials'] = (
+                            'File status have not been changed, the file '
+                            'check was skipped due to file\'s '
+                            'unexpired upload credentials'
+                        )
+            else:
+                job['errors']['get_upload_url_request'] = \
+                    f'{r.status_code} {r.reason}\n{r.text}'
+            r = edit_r
+            if r.ok:
+                item = job['item'] = r.json()
+                job['etag'] = r.headers['etag']
+            else:
+                errors['get_edit_request'] = \
+                    f'{r.status_code} {r.reason}\n{r.text}'
 
-        if errors:
-            # Probably a transient error
-            job['skip'] = True
+            if errors:
+                # Probably a transient error
+                job['skip'] = True
 
-        if local_file:
-            job['local_file'] = local_file
+            if local_file:
+                job['local_file'] = local_file
 
-        yield job
+            yield job
 
 
 def patch_file(session, url, job):
@@ -1335,9 +1529,9 @@ def patch_file(session, url, job):
     else:
         if 'fastq_format_readname' in errors:
             update_content_error(errors,
-                                 'Fastq file contains read names that don’t follow ' +
-                                 'the Illumina standard naming schema; for example {}'.format(
-                                     errors['fastq_format_readname']))
+                                 'Fastq file contains read names that don’t follow '
+                                 'the Illumina standard naming schema; for example '
+                                 f"{errors['fastq_format_readname']}")
         # content_error_detail is truncated to allow indexing in cases of very long error messages
         if 'content_error' in errors:
             data = {
@@ -1364,44 +1558,53 @@ def patch_file(session, url, job):
     if data:
         item_url = urljoin(url, job['@id'])
 
+        # the portal answers If-Match with a 412 when the file was edited
+        # since fetch_files read its etag
         try:
-            etag_r = session.get(item_url + '?frame=edit&datastore=database')
+            r = session.patch(
+                item_url,
+                data=json.dumps(data),
+                headers={
+                    'If-Match': job['etag'],
+                    'Content-Type': 'application/json',
+                },
+            )
         except requests.exceptions.RequestException as e:
-            errors['lookup_for_etag'] = 'Network error occured, while looking for ' + \
-                                                   'etag of the file object to be patched on the portal. ' + \
-                                                   str(e)
+            errors['patch_file_request'] = 'Network error occured, while patching ' + \
+                                           'the file object on the portal. ' + str(e)
         else:
-            if etag_r.ok:
-                if job['etag'] == etag_r.headers['etag']:
-                    r = session.patch(
-                        item_url,
-                        data=json.dumps(data),
-                        headers={
-                            'If-Match': job['etag'],
-                            'Content-Type': 'application/json',
-                        },
-                    )
-                    if not r.ok:
-                        errors['patch_file_request'] = \
-                            '{} {}\n{}'.format(r.status_code, r.reason, r.text)
-                    else:
-                        job['patched'] = True
-                else:
-                    errors['etag_does_not_match'] = 'Original etag was {}, but the current etag is {}.'.format(
-                        job['etag'], etag_r.headers['etag']) + ' File {} '.format(job['item'].get('accession', 'UNKNOWN')) + \
-                        'was {} and now is {}.'.format(job['item'].get('status', 'UNKNOWN'), etag_r.json()['status'])
+            if r.status_code == 412:
+                errors['etag_does_not_match'] = (
+                    f"Original etag was {job['etag']}, but the file has changed since. "
+                    f"File {job['item'].get('accession', 'UNKNOWN')} "
+                    f"was {job['item'].get('status', 'UNKNOWN')}.")
+            elif not r.ok:
+                errors['patch_file_request'] = \
+                    f'{r.status_code} {r.reason}\n{r.text}'
+            else:
+                job['patched'] = True
     return
 
 
+# session of a pool worker process, set up by init_worker
+worker_session = None
+
+
+def init_worker(username, password):
+    global worker_session
+    worker_session = make_session(username, password)
+
+
+def check_file_in_worker(config, url, job):
+    return check_file(config, worker_session, url, job)
+
+
 def run(out, err, url, username, password, encValData, mirror, search_query, file_list=None,
         bot_token=None, local_file=None, processes=None, include_unexpired_upload=False,
         dry_run=False, json_out=False):
-    import functools
     import multiprocessing
 
-    session = requests.Session()
-    session.auth = (username, password)
-    session.headers['Accept'] = 'application/json'
+    session = make_session(username, password)
 
     config = {
         'encValData': encValData,
@@ -1411,24 +1614,34 @@ def run(out, err, url, username, password, encValData, mirror, search_query, fil
     dr = ""
     if dry_run:
         dr = "-- Dry Run"
-    try:
-        nprocesses = multiprocessing.cpu_count()
-    except multiprocessing.NotImplmentedError:
-        nprocesses = 1
+    if processes is not None:
+        nprocesses = processes
+    else:
+        try:
+            nprocesses = multiprocessing.cpu_count()
+        except NotImplementedError:
+            nprocesses = 1
+    # a lone file is checked in this process, without forking a pool,
+    # and a short file list gets no more workers than it has files
+    if local_file:
+        nprocesses = 0
+    elif file_list and nprocesses:
+        nfiles = 0
+        if os.path.isfile(file_list):
+            with open(file_list) as accessions_file:
+                # counted the way fetch_files reads them, blank lines left out
+                nfiles = sum(1 for line in accessions_file if line.strip())
+        nprocesses = min(nprocesses, nfiles) if nfiles > 1 else 0
 
     version = '1.25'
 
-    try:
-        ip_output = subprocess.check_output(
-            ['hostname'], stderr=subprocess.STDOUT).strip()
-        ip = ip_output.decode(errors='replace').rstrip('\n')
-    except subprocess.CalledProcessError as e:
-        ip = ''
+    ip = socket.gethostname()
 
-    initiating_run = 'STARTING Checkfiles version ' + \
-        '{} ({}) ({}): with {} processes {} on {} at {}'.format(
-            version, url, search_query, nprocesses, dr, ip, datetime.datetime.now())
+    initiating_run = (
+        f'STARTING Checkfiles version {version} ({url}) ({search_query}): '
+        f'with {nprocesses} processes {dr} on {ip} at {datetime.datetime.now()}')
     if bot_token:
+        from slackclient import SlackClient
         sc = SlackClient(bot_token)
         sc.api_call(
             "chat.postMessage",
@@ -1439,12 +1652,19 @@ def run(out, err, url, username, password, encValData, mirror, search_query, fil
 
     out.write(initiating_run + '\n')
     out.flush()
-    if processes == 0:
+    pool = None
+    if nprocesses == 0:
         # Easier debugging without multiprocessing.
         imap = map
+        check = functools.partial(check_file, config, session, url)
     else:
-        pool = multiprocessing.Pool(processes=processes)
-        imap = pool.imap_unordered
+        # each worker keeps one session, and so its open connections, for all of its jobs
+        pool = multiprocessing.Pool(processes=nprocesses, initializer=init_worker,
+                                    initargs=(username, password))
+        # one job per task: a check runs for seconds to hours, so batching saves
+        # nothing on pickling and would leave workers idle behind a slow file
+        imap = functools.partial(pool.imap_unordered, chunksize=1)
+        check = functools.partial(check_file_in_worker, config, url)
 
     jobs = fetch_files(session, url, search_query, out, include_unexpired_upload, file_list, local_file)
     if not json_out:
@@ -1452,7 +1672,9 @@ def run(out, err, url, username, password, encValData, mirror, search_query, fil
                                 'Upload Expiration'])
         out.write(headers + '\n')
         out.flush()
-    for job in imap(functools.partial(check_file, config, session, url), jobs):
+    output_lock = threading.Lock()
+
+    def patch_and_report(job):
         if not dry_run:
             patch_file(session, url, job)
         tab_report = '\t'.join([
@@ -1463,20 +1685,50 @@ def run(out, err, url, username, password, encValData, mirror, search_query, fil
             job.get('download_url', ''),
             job.get('upload_expiration', ''),
             ])
-        if json_out:
-            out.write(json.dumps(job) + '\n')
-            out.flush()
-            if job['errors']:
-                err.write(json.dumps(job) + '\n')
-                err.flush()
-        else:
-            out.write(tab_report + '\n')
-            out.flush()
-            if job['errors']:
-                err.write(tab_report + '\n')
-                err.flush()
-
-    finishing_run = 'FINISHED Checkfiles at {}'.format(datetime.datetime.now())
+        # out and err are line buffered, every report line is written as it comes
+        with output_lock:
+            if json_out:
+                out.write(json.dumps(job) + '\n')
+                if job['errors']:
+                    err.write(json.dumps(job) + '\n')
+            else:
+                out.write(tab_report + '\n')
+                if job['errors']:
+                    err.write(tab_report + '\n')
+
+    # the pool takes jobs as fast as fetch_files makes them, so only a couple
+    # per process are let in before their results come back
+    in_flight = threading.BoundedSemaphore(max(nprocesses, 1) * 2)
+
+    def throttled(jobs):
+        for job in jobs:
+            in_flight.acquire()
+            yield job
+
+    def checked(results):
+        for job in results:
+            in_flight.release()
+            yield job
+
+    # checked files are patched by a few threads, so the results of the
+    # pool keep being collected while patches wait on the portal; at most
+    # two patches per thread are queued, and finished ones are let go, so
+    # the checked jobs are not held until the end of the run
+    patches = set()
+    with ThreadPoolExecutor(max_workers=PATCH_THREADS) as patcher:
+        for job in checked(imap(check, throttled(jobs))):
+            if len(patches) >= PATCH_THREADS * 2:
+                done, patches = wait(patches, return_when=FIRST_COMPLETED)
+                for patch in done:
+                    patch.result()
+            patches.add(patcher.submit(patch_and_report, job))
+        for patch in patches:
+            patch.result()
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    finishing_run = f'FINISHED Checkfiles at {datetime.datetime.now()}'
     out.write(finishing_run + '\n')
     out.flush()
     output_filename = out.name
@@ -1485,18 +1737,19 @@ def run(out, err, url, username, password, encValData, mirror, search_query, fil
     err.close()
 
     if bot_token:
-        with open(output_filename, 'r') as output_file:
+        # the logs go up as multipart file uploads, not decoded into a content string
+        with open(output_filename, 'rb') as output_file:
             x = sc.api_call("files.upload",
                             title=output_filename,
                             channels='#bot-reporting',
-                            content=output_file.read(),
+                            file=output_file,
                             as_user=True)
 
-        with open(error_filename, 'r') as output_file:
+        with open(error_filename, 'rb') as output_file:
             x = sc.api_call("files.upload",
                             title=error_filename,
                             channels='#bot-reporting',
-                            content=output_file.read(),
+                            file=output_file,
                             as_user=True)
 
         sc.api_call(
@@ -1523,10 +1776,10 @@ def main():
         '--password', '-p', default='',
         help="HTTP password (secret_access_key)")
     parser.add_argument(
-        '--out', '-o', type=argparse.FileType('w'), default=sys.stdout,
+        '--out', '-o', type=argparse.FileType('w', bufsize=1), default=sys.stdout,
         help="file to write json lines of results with or without errors")
     parser.add_argument(
-        '--err', '-e', type=argparse.FileType('w'), default=sys.stderr,
+        '--err', '-e', type=argparse.FileType('w', bufsize=1), default=sys.stderr,
         help="file to write json lines of results with errors")
     parser.add_argument(
         '--processes', type=int,
@@ -8,19 +8,35 @@ Example.
 """
 import datetime
 import json
+import os.path
+import socket
 import sys
-import subprocess
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urljoin
+import orjson
 import requests
+from portal_session import make_session
 from slackclient import SlackClient
 
 EPILOG = __doc__
 
-def run(out, url, username, password, bot_token=None, dry_run=False):
-    session = requests.Session()
-    session.auth = (username, password)
-    session.headers['Accept'] = 'application/json'
+
+def patch_matching_md5sum(session, item_url, identical_files_list):
+    return session.patch(
+        item_url,
+        data=json.dumps({
+            "matching_md5sum": identical_files_list,
+        }),
+        headers={
+            'content-type': 'application/json',
+            'accept': 'application/json',
+        },
+    )
+
+
+def run(out, url, username, password, bot_token=None, dry_run=False, etag_file=''):
+    session = make_session(username, password)
 
     dr = ""
     if dry_run:
@@ -28,13 +44,7 @@ def run(out, url, username, password, bot_token=None, dry_run=False):
 
     version = '0.01'
 
-    try:
-        ip_output = subprocess.check_output(
-            ['hostname'], stderr=subprocess.STDOUT
-        ).strip()
-        ip = ip_output.decode(errors='replace').rstrip('\n')
-    except subprocess.CalledProcessError:
-        ip = ''
+    ip = socket.gethostname()
 
     initiating_run = (
         'STARTING matching md5sum files detection, version {} ({}) ({}): {} at {}'
@@ -57,77 +67,101 @@ def run(out, url, username, password, bot_token=None, dry_run=False):
             as_user=True,
         )
 
+    # ETag of the file index seen by the last complete run, per portal
+    etags = {}
+    if etag_file and os.path.isfile(etag_file):
+        with open(etag_file) as f:
+            etags = json.load(f)
+    headers = {}
+    if url in etags:
+        headers['If-None-Match'] = etags[url]
+
     graph = []
     r = session.get(
         urljoin(
             url,
             '/search/?type=File&field=external_accession&field=accession&field=uuid&field=status&field=md5sum&field=matching_md5sum&limit=all&format=json'
-        )
+        ),
+        headers=headers,
     )
+    search_etag = r.headers.get('etag')
     try:
         r.raise_for_status()
     except requests.HTTPError:
         return
     else:
-        graph = r.json()['@graph']
+        # an unchanged index leaves nothing to patch
+        if r.status_code != 304:
+            graph = orjson.loads(r.content)['@graph']
 
+    excluded_statuses = frozenset(['uploading', 'upload failed', 'content error'])
+    patch_failed = False
     accession_to_uuid = {}
-    for f in graph:
-        if (f.get('accession')):
-            accession_to_uuid[f.get('accession')] = f.get('uuid')
-        else:
-            accession_to_uuid[f.get('external_accession')] = f.get('uuid')
-
-    excluded_statuses = ['uploading', 'upload failed', 'content error']
     md5dictionary = defaultdict(set)
-    clashing_dictionary = defaultdict(list)
+    # files with matching_md5sum, resolved once accession_to_uuid is complete
+    matched_files = []
     for f in graph:
+        uuid = f.get('uuid')
+        accession_to_uuid[f.get('accession') or f.get('external_accession')] = uuid
         if f.get('status') not in excluded_statuses:
             md5 = f.get('md5sum')
             if md5:
-                md5dictionary[md5].add(f.get('uuid'))
-            matching_md5sum = f.get('matching_md5sum')
-            if matching_md5sum:
-                matching_md5sum_uuids = [
-                    entry.split('/')[2] 
-                        if (len(entry.split('/')[2]) == 36 
-                            and (entry.split('/')[2]).find('-') != -1)
-                        else accession_to_uuid.get(entry.split('/')[2]) for entry in matching_md5sum
-                ]
-                clashing_dictionary[f.get('uuid')] = sorted(matching_md5sum_uuids)
-    for key, value in md5dictionary.items():
-        if len(value) > 1:
-            uuids_list = sorted(list(value))
-            for uuid in uuids_list:
-                identical_files_list = [
-                    entry for entry in uuids_list if entry != uuid
-                ]
-                if uuid not in clashing_dictionary or sorted(clashing_dictionary[uuid]) != sorted(identical_files_list):
-                    item_url = urljoin(url, uuid)
-                    data = {
-                        "matching_md5sum": identical_files_list,
-                    }
-                    if not dry_run:
-                        r = session.patch(
-                            item_url,
-                            data=json.dumps(data),
-                            headers={
-                                'content-type': 'application/json',
-                                'accept': 'application/json',
-                            },
+                md5dictionary[md5].add(uuid)
+            if f.get('matching_md5sum'):
+                matched_files.append(f)
+    # only files sharing their md5sum can need a patch
+    duplicates = {
+        md5: sorted(uuids) for md5, uuids in md5dictionary.items() if len(uuids) > 1
+    }
+    duplicated_uuids = set().union(*duplicates.values())
+
+    clashing_dictionary = {}
+    for f in matched_files:
+        if f.get('uuid') in duplicated_uuids:
+            matching_md5sum_uuids = []
+            for entry in f['matching_md5sum']:
+                # entries are /files/<uuid or accession>/
+                file_id = entry.split('/', 3)[2]
+                if len(file_id) == 36 and '-' in file_id:
+                    matching_md5sum_uuids.append(file_id)
+                else:
+                    matching_md5sum_uuids.append(accession_to_uuid.get(file_id))
+            clashing_dictionary[f.get('uuid')] = sorted(matching_md5sum_uuids)
+    pending_patches = []
+    for key, uuids_list in duplicates.items():
+        for uuid in uuids_list:
+            identical_files_list = [
+                entry for entry in uuids_list if entry != uuid
+            ]
+            # both lists are already sorted, and files missing from
+            # clashing_dictionary have no matching_md5sum yet
+            if clashing_dictionary.get(uuid) != identical_files_list:
+                pending_patches.append((uuid, key, identical_files_list))
+
+    if not dry_run:
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            responses = pool.map(
+                lambda pending_patch: patch_matching_md5sum(
+                    session, urljoin(url, pending_patch[0]), pending_patch[2]),
+                pending_patches)
+            for (uuid, key, identical_files_list), r in zip(pending_patches, responses):
+                if not r.ok:
+                    patch_failed = True
+                    print('{} {}\n{}'.format(r.status_code, r.reason, r.text))
+                else:
+                    out.write(
+                        '{}\tmd5:{}\t{}\n'.format(
+                            uuid,
+                            key,
+                            identical_files_list,
                         )
-                        if not r.ok:
-                            print('{} {}\n{}'.format(r.status_code, r.reason, r.text))
-                        else:
-                            out.write(
-                                '{}\tmd5:{}\t{}\n'.format(
-                                    uuid,
-                                    key,
-                                    identical_files_list,
-                                )
-                            )
-
-                        out.flush()
+                    )
+        out.flush()
+
+    if etag_file and search_etag and not dry_run and not patch_failed:
+        etags[url] = search_etag
+        with open(etag_file, 'w') as f:
+            json.dump(etags, f)
 
     finishing_run = 'FINISHED matching md5sum files detection at {}'.format(
         datetime.datetime.now()
@@ -173,6 +207,11 @@ def main():
         action='store_true',
         help="Don't update status, just check",
     )
+    parser.add_argument(
+        '--etag-file',
+        default='',
+        help="file keeping the file index ETag, to skip unchanged indexes",
+    )
     parser.add_argument('url', help="server to post to")
     args = parser.parse_args()
     run(**vars(args))
@@ -1,10 +1,14 @@
-import boto3
+import functools
 import getpass
+import hashlib
+import os
 import re
 import shlex
 import subprocess
 import sys
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from os.path import expanduser
 
 
@@ -20,27 +24,56 @@ BDM = [
 ]
 
 
+# looked up once per process
+SSH_KEY_PATH = expanduser('~/.ssh/id_rsa.pub')
+
+# aws s3 authorized_keys folders, production or demo for any other profile
+AUTH_KEYS = {
+    'production': 's3://encoded-conf-prod/ssh-keys/prod-authorized_keys',
+    None: 's3://encoded-conf-prod/ssh-keys/demo-authorized_keys',
+}
+
+# runs of characters that are not alphanumeric, \W alone would keep underscores
+non_alnum_runs = re.compile(r'[\W_]+')
+
+# what nameify produces for ascii input: lowercase alphanumerics in single dash separated runs
+match_hostname = re.compile(r'[a-z0-9]+(?:-[a-z0-9]+)*', re.ASCII).fullmatch
+
+
 def nameify(s):
-    name = ''.join(c if c.isalnum() else '-' for c in s.lower()).strip('-')
-    return re.subn(r'\-+', '-', name)[0]
+    return non_alnum_runs.sub('-', s.lower()).strip('-')
+
 
+@functools.lru_cache(maxsize=1)
+def get_username():
+    # looked up on first use, getuser raises where there is no login name
+    return getpass.getuser()
 
+
+@functools.lru_cache(maxsize=1)
 def read_ssh_key():
-    home = expanduser("~")
-    ssh_key_path = home + '/' + '.ssh/id_rsa.pub'
-    ssh_keygen_args = ['ssh-keygen', '-l', '-f', ssh_key_path]
-    fingerprint = subprocess.check_output(
-        ssh_keygen_args
-    ).decode('utf-8').strip()
-    if fingerprint:
-        with open(ssh_key_path, 'r') as f:
-            ssh_pub_key = f.readline().strip()
-            return ssh_pub_key
+    # unbuffered read, the key is a single short line
+    try:
+        fd = os.open(SSH_KEY_PATH, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    try:
+        data = os.read(fd, 1 << 16)
+    finally:
+        os.close(fd)
+    return data.split(b'\n', 1)[0].decode('utf-8').strip()
+
+
+@functools.lru_cache(maxsize=8)
+def read_config_template(commit, config_file):
+    # plumbing read of the blob, without the textconv and pager setup of git show
+    cmd_list = ['git', 'cat-file', 'blob', commit + config_file]
+    return subprocess.run(
+        cmd_list, check=True, stdout=subprocess.PIPE, encoding='utf-8').stdout
 
 
 def get_user_data(commit, config_file, data_insert, profile_name):
-    cmd_list = ['git', 'show', commit + config_file]
-    config_template = subprocess.check_output(cmd_list).decode('utf-8')
+    config_template = read_config_template(commit, config_file)
     ssh_pub_key = read_ssh_key()
     if not ssh_pub_key:
         print(
@@ -48,53 +81,77 @@ def get_user_data(commit, config_file, data_insert, profile_name):
             "new instance because they have no ssh key"
         )
     data_insert['LOCAL_SSH_KEY'] = ssh_pub_key
-    # aws s3 authorized_keys folder
-    auth_base = 's3://encoded-conf-prod/ssh-keys'
-    auth_type = 'prod'
-    if profile_name != 'production':
-        auth_type = 'demo'
-    auth_keys_dir = '{auth_base}/{auth_type}-authorized_keys'.format(
-        auth_base=auth_base,
-        auth_type=auth_type,
-    )
-    data_insert['S3_AUTH_KEYS'] = auth_keys_dir
+    data_insert['S3_AUTH_KEYS'] = AUTH_KEYS.get(profile_name, AUTH_KEYS[None])
     user_data = config_template % data_insert
     return user_data
 
 
+def ec2_client(profile_name):
+    import boto3
+    session = boto3.Session(region_name='us-west-2', profile_name=profile_name)
+    return session.client('ec2')
+
+
+def instance_exists(ec2, name):
+    # one match is enough, 5 is the smallest page EC2 accepts. A filtered
+    # page can come back empty with more to follow, so follow NextToken
+    # until a match or the last page.
+    page = {}
+    while True:
+        response = ec2.describe_instances(
+            Filters=[
+                {'Name': 'tag:Name', 'Values': [name]},
+                {'Name': 'instance-state-name',
+                 'Values': ['pending', 'running', 'stopping', 'stopped']},
+            ],
+            MaxResults=5,
+            **page)
+        if any(reservation['Instances'] for reservation in response['Reservations']):
+            return True
+        if not response.get('NextToken'):
+            return False
+        page = {'NextToken': response['NextToken']}
+
+
 def run(image_id, instance_type,
         branch=None, name=None, profile_name=None, args=()):
-    if branch is None:
-        branch = subprocess.check_output(
-            ['git', 'rev-parse', '--abbrev-ref', 'HEAD']
-            ).decode('utf-8').strip()
-
-    commit = subprocess.check_output(
-        ['git', 'rev-parse', '--short', branch]).decode('utf-8').strip()
+    # credentials and the ec2 service model load while git is queried
+    executor = ThreadPoolExecutor(max_workers=1)
+    ec2_future = executor.submit(ec2_client, profile_name)
 
-    if not subprocess.check_output(
-            ['git', 'branch', '-r', '--contains', commit]).strip():
+    if branch is None:
+        branch = subprocess.run(
+            ['git', 'rev-parse', '--abbrev-ref', 'HEAD'],
+            check=True, stdout=subprocess.PIPE, encoding='utf-8').stdout.strip()
+
+    commit = subprocess.run(
+        ['git', 'rev-parse', '--short', branch],
+        check=True, stdout=subprocess.PIPE, encoding='utf-8').stdout.strip()
+
+    # the branch's own remote ref answers in one ancestry check, only a
+    # commit that is not there needs the scan of every remote branch
+    pushed = subprocess.run(
+        ['git', 'merge-base', '--is-ancestor', commit, 'origin/' + branch],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+    if not pushed and not subprocess.run(
+            ['git', 'branch', '-r', '--contains', commit],
+            check=True, stdout=subprocess.PIPE, encoding='utf-8').stdout.strip():
         print("Commit %r not in origin. Did you git push?" % commit)
         sys.exit(1)
 
-    username = getpass.getuser()
+    username = get_username()
 
     if name is None:
         name = nameify('checkfiles-%s-%s-%s' % (branch, commit, username))
 
-    session = boto3.Session(region_name='us-west-2', profile_name=profile_name)
-    ec2 = session.resource('ec2')
+    # the name lookup runs on the same thread, after the session is ready,
+    # while the user data is put together here
+    exists_future = executor.submit(
+        lambda: instance_exists(ec2_future.result(), name))
+    executor.shutdown(wait=False)
 
     domain = 'production' if profile_name == 'production' else 'instance'
 
-    if any(ec2.instances.filter(
-            Filters=[
-                {'Name': 'tag:Name', 'Values': [name]},
-                {'Name': 'instance-state-name',
-                 'Values': ['pending', 'running', 'stopping', 'stopped']},
-            ])):
-        print('An instance already exists with name: %s' % name)
-        sys.exit(1)
     # Add template data to cloud config file
     config_file = ':cloud-config.yml'
     data_insert = {
@@ -102,7 +159,19 @@ def run(image_id, instance_type,
         'ARGS': ' '.join(shlex.quote(arg) for arg in args),
     }
     user_data = get_user_data(commit, config_file, data_insert, 'demo')
-    reservation = ec2.create_instances(
+
+    if exists_future.result():
+        print('An instance already exists with name: %s' % name)
+        sys.exit(1)
+    ec2 = ec2_future.result()
+    # two deploys of the same name, commit and user racing past the check
+    # above get one instance back from EC2. The token is only remembered
+    # for a while, and a ten minute slot keeps a later redeploy, after
+    # the first instance was terminated, from being handed that instance.
+    client_token = hashlib.sha256(('%s|%s|%s|%d' % (
+        name, commit, username, time.time() // 600)).encode('utf-8')).hexdigest()
+    reservation = ec2.run_instances(
+        ClientToken=client_token,
         MinCount=1,
         MaxCount=1,
         ImageId=image_id,
@@ -114,26 +183,46 @@ def run(image_id, instance_type,
         IamInstanceProfile={'Name': 'encoded-instance'},
     )
 
-    instance = reservation[0]  # Instance:i-34edd56f
-    print('%s.%s.encodedcc.org' % (instance.instance_id, domain))
-    instance.wait_until_exists()
-    instance.create_tags(Tags=[
-        {'Key': 'Name', 'Value': name},
-        {'Key': 'branch', 'Value': branch},
-        {'Key': 'commit', 'Value': commit},
-        {'Key': 'started_by', 'Value': username},
-    ])
-    print('ssh ubuntu@%s.%s.encodedcc.org' % (name, domain))
-    print('pending...')
-    instance.wait_until_running()
-    print(instance.state['Name'])
+    instance_id = reservation['Instances'][0]['InstanceId']  # i-34edd56f
+    from botocore.exceptions import ClientError
+    # a new instance id can take a moment to be known to CreateTags
+    for attempt in range(5):
+        try:
+            ec2.create_tags(Resources=[instance_id], Tags=[
+                {'Key': 'Name', 'Value': name},
+                {'Key': 'branch', 'Value': branch},
+                {'Key': 'commit', 'Value': commit},
+                {'Key': 'started_by', 'Value': username},
+            ])
+        except ClientError as e:
+            if (e.response['Error']['Code'] != 'InvalidInstanceID.NotFound'
+                    or attempt == 4):
+                raise
+            time.sleep(0.5 * (1 << attempt))
+        else:
+            break
+    # the hostnames go out together once the instance is tagged, the final
+    # state follows on its own line after the wait
+    print('\n'.join([
+        '%s.%s.encodedcc.org' % (instance_id, domain),
+        'ssh ubuntu@%s.%s.encodedcc.org' % (name, domain),
+        'pending...',
+    ]), flush=True)
+    # poll every 5s instead of the default 15s, for up to 10 minutes; the
+    # pinned botocore predates WaiterConfig, so set the waiter's own config
+    waiter = ec2.get_waiter('instance_running')
+    waiter.config.delay = 5
+    waiter.config.max_attempts = 120
+    waiter.wait(InstanceIds=[instance_id])
+    # the waiter raises unless the instance reached the running state
+    print('running')
 
 
 def main():
     import argparse
 
     def hostname(value):
-        if value != nameify(value):
+        if not match_hostname(value):
             raise argparse.ArgumentTypeError(
                 "%r is an invalid hostname, only [a-z0-9] and hyphen allowed."
                 % value)
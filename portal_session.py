@@ -0,0 +1,28 @@
+"""\
+HTTP session shared by the checkfiles, checkexperiments and checkmd5 scripts.
+"""
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def make_session(username, password):
+    session = requests.Session()
+    session.auth = (username, password)
+    session.headers['Accept'] = 'application/json'
+    # pooled keep-alive connections for the worker threads, and retry
+    # transient gateway errors on GETs only: a PATCH the portal applied
+    # before a gateway error would be retried into a 412 from If-Match,
+    # or sent twice without it
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.3,
+            status_forcelist=[502, 503, 504],
+            method_whitelist=frozenset(['GET']),
+            raise_on_status=False))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
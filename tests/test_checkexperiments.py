@@ -0,0 +1,88 @@
+import io
+import json
+import threading
+
+import pytest
+import requests
+
+import checkexperiments
+
+
+@pytest.mark.parametrize('search_query, filters', [
+    ('', [('status', 'in progress'), ('award.rfa!', 'modERN')]),
+    ('accession=ENCSR000ABC', [('status', 'in progress'), ('award.rfa!', 'modERN')]),
+    ('status=in progress', [('award.rfa!', 'modERN')]),
+    ('status=released&lab.title=Some+Lab', [('award.rfa!', 'modERN')]),
+    ('status!=deleted', [('award.rfa!', 'modERN')]),
+])
+def test_screening_filters(search_query, filters):
+    assert checkexperiments.screening_filters(search_query) == filters
+
+
+class Log(io.StringIO):
+    name = 'log'
+
+    def close(self):
+        self.text = self.getvalue()
+        super().close()
+
+
+class SearchResponse:
+    def __init__(self, graph):
+        self.content = json.dumps({'@graph': graph}).encode()
+
+    def raise_for_status(self):
+        pass
+
+
+class SearchPortal:
+    def __init__(self, graph):
+        self.graph = graph
+
+    def get(self, url, params=None):
+        return SearchResponse(self.graph)
+
+
+class PatchResponse:
+    ok = True
+
+
+def run(monkeypatch, count, check_experiment, patch_experiment):
+    graph = [{'@id': '/experiments/ENCSR%03dAAA/' % i} for i in range(count)]
+    monkeypatch.setattr(checkexperiments, 'make_session', lambda *args: SearchPortal(graph))
+    monkeypatch.setattr(checkexperiments, 'check_experiment', check_experiment)
+    monkeypatch.setattr(checkexperiments, 'patch_experiment', patch_experiment)
+    out = Log()
+    checkexperiments.run(out, Log(), 'https://portal', '', '', 'status=in progress')
+    return out.text
+
+
+def test_patches_do_not_wait_for_the_remaining_checks(monkeypatch):
+    patched = threading.Event()
+
+    def check_experiment(ex_id, *args):
+        if ex_id == '/experiments/ENCSR000AAA/':
+            return (ex_id, {'status': 'submitted'}, 'report 0\n')
+        # every check worker waits here until the first patch is sent
+        assert patched.wait(5)
+
+    def patch_experiment(session, item_url, data):
+        patched.set()
+        return PatchResponse()
+
+    assert 'report 0\n' in run(monkeypatch, 17, check_experiment, patch_experiment)
+
+
+def test_failed_patch_does_not_drop_the_other_reports(monkeypatch):
+    def check_experiment(ex_id, *args):
+        return (ex_id, {'status': 'submitted'}, 'report {}\n'.format(ex_id))
+
+    def patch_experiment(session, item_url, data):
+        if item_url == '/experiments/ENCSR000AAA/':
+            raise requests.exceptions.ConnectionError('connection reset')
+        return PatchResponse()
+
+    text = run(monkeypatch, 3, check_experiment, patch_experiment)
+    assert 'report /experiments/ENCSR000AAA/' not in text
+    assert 'report /experiments/ENCSR001AAA/' in text
+    assert 'report /experiments/ENCSR002AAA/' in text
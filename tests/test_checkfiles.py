@@ -0,0 +1,224 @@
+import gzip
+import hashlib
+import io
+import threading
+import time
+from urllib.parse import urlencode
+
+import pytest
+import requests
+
+import checkfiles
+
+
+FASTQ = b''.join(
+    b'@M00123:1:FC123:1:1101:%d:1000 1:N:0:ACGTACGT\n'
+    b'ACGTACGTAC\n'
+    b'+\n'
+    b'IIIIIIIIII\n' % i
+    for i in range(3))
+
+
+class ShortReads(io.BytesIO):
+    """ A pipe that hands out at most size bytes per read1 call """
+    def __init__(self, data, size):
+        super().__init__(data)
+        self.size = size
+
+    def read1(self, size=-1):
+        return super().read1(self.size)
+
+
+class FakeGunzip:
+    def __init__(self, data, size):
+        self.stdout = ShortReads(data, size)
+
+
+def offline(monkeypatch, read_name_details=None):
+    monkeypatch.setattr(checkfiles, 'get_platform_uuid', lambda *args: None)
+    monkeypatch.setattr(checkfiles, 'get_read_name_details', lambda *args: read_name_details)
+    monkeypatch.setattr(checkfiles, 'check_for_fastq_signature_conflicts', lambda *args: None)
+
+
+def check_fastq(data, size):
+    job = {'@id': '/files/ENCFF000AAA/', 'item': {'read_length': 10}, 'errors': {}, 'result': {}}
+    checkfiles.process_fastq_file(job, FakeGunzip(data, size), None, None)
+    return job
+
+
+SHORT_READS = pytest.mark.parametrize('data, size', [
+    (FASTQ, 7),
+    (FASTQ, 1),
+    (FASTQ.rstrip(b'\n'), checkfiles.FASTQ_READ_SIZE),
+], ids=['7 byte reads', '1 byte reads', 'no final newline'])
+
+
+@SHORT_READS
+def test_process_fastq_file_short_reads(monkeypatch, data, size):
+    offline(monkeypatch)
+    job = check_fastq(data, size)
+    assert job['errors'] == {}
+    assert job['result']['read_count'] == 3
+    assert job['result']['fastq_signature'] == ['FC123:1:1:ACGTACGT:']
+
+
+@SHORT_READS
+def test_process_fastq_file_short_reads_with_read_name_details(monkeypatch, data, size):
+    offline(monkeypatch, {'flowcell_id_location': 2, 'lane_id_location': 3})
+    job = check_fastq(data, size)
+    assert job['errors'] == {}
+    assert job['result']['read_count'] == 3
+
+
+class FakeResponse:
+    def __init__(self, ok, body):
+        self.ok = ok
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class FlakyPortal:
+    """ A session whose first GET fails """
+    def __init__(self):
+        self.calls = 0
+
+    def get(self, url):
+        self.calls += 1
+        if self.calls == 1:
+            return FakeResponse(False, {'status': 'error'})
+        return FakeResponse(True, {'uuid': 'platform-uuid'})
+
+
+def test_get_object_does_not_cache_errors(monkeypatch):
+    monkeypatch.setattr(checkfiles, 'portal_objects', {})
+    session = FlakyPortal()
+    assert checkfiles.get_object('/platforms/A/', session, 'https://portal') == {'status': 'error'}
+    assert checkfiles.get_object('/platforms/A/', session, 'https://portal') == {'uuid': 'platform-uuid'}
+    assert checkfiles.get_object('/platforms/A/', session, 'https://portal') == {'uuid': 'platform-uuid'}
+    assert session.calls == 2
+
+
+@pytest.mark.parametrize('suffix', ['', '/1', '/2', '/1/2', '/', '|', '12'])
+def test_special_read_name_suffixes(suffix):
+    read_name = '@M00123:1:FC123:1:1101:1:1000' + suffix + ' 1:N:0:ACGTACGT'
+    assert checkfiles.match_special_read_name(read_name)
+
+
+class RecordingPortal:
+    """ A session that records the searches it is sent """
+    def __init__(self):
+        self.urls = []
+
+    def get(self, url):
+        self.urls.append(url)
+        return FakeSearchResponse()
+
+
+class FakeSearchResponse:
+    content = b'{"@graph": []}'
+
+    def raise_for_status(self):
+        pass
+
+
+def test_fetch_files_skips_blank_accessions(tmp_path):
+    file_list = tmp_path / 'accessions.txt'
+    file_list.write_text('ENCFF000AAA\n\n  \nENCFF000AAB  \n\n')
+    session = RecordingPortal()
+    list(checkfiles.fetch_files(session, 'https://portal', None, None, file_list=str(file_list)))
+    assert len(session.urls) == 1
+    assert session.urls[0].endswith('&accession=ENCFF000AAA&accession=ENCFF000AAB')
+
+
+def test_md5sum_file_content(tmp_path):
+    path = tmp_path / 'reads.fastq.gz'
+    path.write_bytes(gzip.compress(FASTQ))
+    md5sum, content_output, content_error = checkfiles.md5sum_file(str(path), content=True)
+    assert md5sum == hashlib.md5(path.read_bytes()).hexdigest()
+    assert content_output.split()[0].decode() == hashlib.md5(FASTQ).hexdigest()
+    assert content_error is None
+
+
+def test_md5sum_file_content_error(tmp_path):
+    path = tmp_path / 'reads.fastq.gz'
+    path.write_bytes(FASTQ)
+    md5sum, content_output, content_error = checkfiles.md5sum_file(str(path), content=True)
+    assert md5sum == hashlib.md5(FASTQ).hexdigest()
+    assert content_output is None
+    assert 'not in gzip format' in content_error
+
+
+def test_signature_batches_stay_within_search_length():
+    signatures = ['@M00123:1:FC123:1:1101:%d:1000 1:N:0:ACGTACGT:' % i for i in range(500)]
+    batches = list(checkfiles.signature_batches(signatures))
+    assert [s for batch in batches for s in batch] == signatures
+    for batch in batches:
+        assert len(urlencode([('fastq_signature', s) for s in batch])) <= checkfiles.SIGNATURE_SEARCH_LENGTH
+
+
+class TooLongResponse:
+    status_code = 414
+
+    def raise_for_status(self):
+        raise requests.HTTPError('414 Client Error: Request-URI Too Long')
+
+    def json(self):
+        raise ValueError('Expecting value: line 1 column 1 (char 0)')
+
+
+class TooLongPortal:
+    def get(self, url):
+        return TooLongResponse()
+
+
+def test_fastq_signature_lookup_error_is_reported():
+    errors = {}
+    checkfiles.check_for_fastq_signature_conflicts(
+        TooLongPortal(), 'https://portal', errors, {'accession': 'ENCFF000AAA'}, {'FC123:1:1:ACGTACGT:'})
+    assert '414' in errors['lookup_for_fastq_signature']
+
+
+class Log(io.StringIO):
+    name = 'log'
+
+    def close(self):
+        self.text = self.getvalue()
+        super().close()
+
+
+def test_run_bounds_the_jobs_waiting_to_be_patched(monkeypatch):
+    counts = {'fetched': 0, 'patched': 0, 'outstanding': 0}
+    lock = threading.Lock()
+
+    def fetch_files(*args):
+        for i in range(200):
+            with lock:
+                counts['fetched'] += 1
+                counts['outstanding'] = max(counts['outstanding'], counts['fetched'] - counts['patched'])
+            yield {'@id': '/files/ENCFF%03dAAA/' % i, 'item': {}, 'errors': {}}
+
+    def patch_file(session, url, job):
+        time.sleep(0.001)
+        with lock:
+            counts['patched'] += 1
+
+    monkeypatch.setattr(checkfiles, 'make_session', lambda *args: None)
+    monkeypatch.setattr(checkfiles, 'fetch_files', fetch_files)
+    monkeypatch.setattr(checkfiles, 'check_file', lambda config, session, url, job: job)
+    monkeypatch.setattr(checkfiles, 'patch_file', patch_file)
+    checkfiles.run(Log(), Log(), 'https://portal', '', '', None, None, '', processes=0)
+    assert counts['patched'] == 200
+    # the in-flight check, the queued and the running patches
+    assert counts['outstanding'] <= 1 + checkfiles.PATCH_THREADS * 2 + 1
+
+
+def test_run_checks_a_single_listed_file_without_a_pool(monkeypatch, tmp_path):
+    file_list = tmp_path / 'accessions.txt'
+    file_list.write_text('ENCFF000AAA\n\n')
+    monkeypatch.setattr(checkfiles, 'make_session', lambda *args: None)
+    monkeypatch.setattr(checkfiles, 'fetch_files', lambda *args: iter(()))
+    out = Log()
+    checkfiles.run(out, Log(), 'https://portal', '', '', None, None, '', file_list=str(file_list), processes=4)
+    assert 'with 0 processes' in out.text